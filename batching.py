@@ -0,0 +1,179 @@
+import math
+import numpy as np
+import torch
+from torch.utils import data
+
+
+def pack_documents(documents, eos_token_id):
+    """
+    Concatenates the token ids of every document into one flat uint16 stream, each one followed by <eos>.
+    """
+    documents = [np.asarray(ids, dtype=np.uint16) for ids in documents]
+    stream = np.empty(sum(len(ids) + 1 for ids in documents), dtype=np.uint16)
+    position = 0
+    for ids in documents:
+        stream[position:position + len(ids)] = ids
+        stream[position + len(ids)] = eos_token_id
+        position += len(ids) + 1
+    return stream
+
+
+def document_attention_mask(document_ids):
+    """
+    (B, T, T) boolean mask from the (B, T) document_ids of packed windows: position i may attend to
+    position j only if j <= i and both belong to the same story.
+    """
+    same_document = document_ids.unsqueeze(2) == document_ids.unsqueeze(1)
+    causal = torch.ones(document_ids.size(1), document_ids.size(1), dtype=torch.bool, device=document_ids.device).tril()
+    return same_document & causal
+
+
+class PackedTokenDataset(data.Dataset):
+    """
+    Contiguous block_size windows over a stream built by pack_documents, so no position is spent on [PAD].
+    Consecutive windows overlap by one token: the last token of a window is only an input of the next one,
+    and every token of the stream is predicted exactly once.
+
+    With document_ids=True every item also holds the index of the story each position belongs to (counted
+    from the start of the window), for document_attention_mask.
+    """
+    def __init__(self, stream, block_size, eos_token_id, document_ids=False):
+        self.stream = stream
+        self.block_size = block_size
+        self.eos_token_id = eos_token_id
+        self.document_ids = document_ids
+
+    def __len__(self):
+        return max((len(self.stream) - 1) // (self.block_size - 1), 0)
+
+    def __getitem__(self, idx):
+        start = idx * (self.block_size - 1)
+        input_ids = torch.from_numpy(self.stream[start:start + self.block_size].astype(np.int64))
+        item = {'input_ids': input_ids}
+        if self.document_ids:
+            # A story starts right after every <eos>
+            is_eos = (input_ids == self.eos_token_id).long()
+            item['document_ids'] = torch.cumsum(is_eos, dim=0) - is_eos
+        return item
+
+
+def sequence_lengths(dataset):
+    """
+    Number of tokens of every item of dataset: a TokenShardDataset, a tokenized (unpadded) HuggingFace
+    dataset, or a data.Subset of one of them.
+    """
+    if isinstance(dataset, data.Subset):
+        return sequence_lengths(dataset.dataset)[np.asarray(dataset.indices)]
+    if hasattr(dataset, 'lengths'):
+        return dataset.lengths()
+    if hasattr(dataset, 'with_format'):
+        # Plain lists are much faster to read than one tensor per row
+        return np.array([len(ids) for ids in dataset.with_format(None)['input_ids']])
+    return np.array([len(item['input_ids']) for item in dataset])
+
+
+class LengthBucketSampler(data.Sampler):
+    """
+    Batch sampler that puts stories of similar length in the same batch.
+
+    Every epoch the indices are shuffled and split into buckets of batch_size * bucket_batches stories.
+    Every bucket is sorted by length and cut into batches, and the batches of all buckets are shuffled
+    again, so the batch order stays random while a batch rarely mixes very short and very long stories.
+    """
+    def __init__(self, lengths, batch_size, bucket_batches=50, shuffle=True, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = np.random.default_rng(seed)
+
+    def state_dict(self):
+        # Position of the generator, i.e. the order of the coming epochs
+        return {'generator': self.generator.bit_generator.state}
+
+    def load_state_dict(self, state_dict):
+        self.generator.bit_generator.state = state_dict['generator']
+
+    def __iter__(self):
+        indices = self.generator.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in self.generator.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        bucket_sizes = [min(self.bucket_size, len(self.lengths) - start) for start in range(0, len(self.lengths), self.bucket_size)]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in bucket_sizes)
+        return sum(math.ceil(size / self.batch_size) for size in bucket_sizes)
+
+
+class PadCollator:
+    """
+    collate_fn that right-pads input_ids with [PAD] to the longest story of the batch instead of BLOCK_SIZE.
+    """
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, items):
+        input_ids = torch.nn.utils.rnn.pad_sequence([item['input_ids'] for item in items], batch_first=True, padding_value=self.pad_token_id)
+        return {'input_ids': input_ids}
+
+
+def loader_settings(config, persistent_workers=None):
+    """
+    DataLoader keyword arguments from config: NUM_WORKERS worker processes collating the batches, PIN_MEMORY
+    page-locked batches for asynchronous copies to the GPU, PERSISTENT_WORKERS and PREFETCH_FACTOR batches
+    prepared in advance by every worker. persistent_workers overrides PERSISTENT_WORKERS.
+    """
+    settings = {'num_workers': config['NUM_WORKERS'], 'pin_memory': config['PIN_MEMORY']}
+    if config['NUM_WORKERS'] > 0:
+        settings['persistent_workers'] = config['PERSISTENT_WORKERS'] if persistent_workers is None else persistent_workers
+        settings['prefetch_factor'] = config['PREFETCH_FACTOR']
+    return settings
+
+
+class DevicePrefetcher:
+    """
+    Iterates over loader with every batch already on device. On a GPU the next batch is copied on a side
+    stream while the current one is being trained on (the copy is only asynchronous for pinned batches).
+    On CPU the batches are passed through unchanged.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _copy(self, batch, stream):
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            return {key: value.to(self.device, non_blocking=True) if isinstance(value, torch.Tensor) else value for key, value in batch.items()}
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            yield from self.loader
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        next_batch = self._copy(next(batches, None), stream)
+        while next_batch is not None:
+            # The compute stream waits for the copy, and the copied tensors are kept alive until it used them
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    value.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._copy(next(batches, None), stream)
+            yield batch
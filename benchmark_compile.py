@@ -0,0 +1,84 @@
+"""
+Compile time against the steady-state time per step of the compiled execution modes, for both models:
+
+- training: train_step in eager mode and with compile_model (torch.compile)
+- inference: a next_token_logits decoding step in eager mode and from an export_decoder artifact
+
+The break-even column is the number of steps after which the compilation has paid for itself.
+
+    python benchmark_compile.py --models GPT2FromScratch Transformer21MFinalSingleLayer --batch-size 8
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+
+from models import MODEL_CLASSES, build_model
+from training import train_step
+from precision import make_grad_scaler
+from compilation import compile_model, export_decoder, load_decoder
+
+
+def seconds_per_step(step_fn, n_steps, warmup_steps=2):
+    for _ in range(warmup_steps):
+        step_fn()
+    start_time = time.perf_counter()
+    for _ in range(n_steps):
+        step_fn()
+    return (time.perf_counter() - start_time) / n_steps
+
+
+def report(label, compile_seconds, eager_step, compiled_step):
+    saved = eager_step - compiled_step
+    break_even = f"{compile_seconds / saved:.0f}" if saved > 0 else "never"
+    print(f"{label:>42}{compile_seconds:>11.1f}{eager_step * 1e3:>12.2f}{compiled_step * 1e3:>15.2f}{eager_step / compiled_step:>10.2f}x{break_even:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile time vs steady-state speedup of torch.compile training and exported decoding.")
+    parser.add_argument("--models", nargs="+", default=sorted(MODEL_CLASSES), choices=sorted(MODEL_CLASSES))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--block-size", type=int, default=128)
+    parser.add_argument("--train-steps", type=int, default=10)
+    parser.add_argument("--decode-batch-size", type=int, default=1)
+    parser.add_argument("--decode-steps", type=int, default=200)
+    parser.add_argument("--no-aot-compile", action="store_true", help="Export the decoder without AOTInductor")
+    args = parser.parse_args()
+
+    print(f"{'':>42}{'compile s':>11}{'eager ms':>12}{'compiled ms':>15}{'speedup':>11}{'break-even':>13}")
+    for model_name in args.models:
+        torch.manual_seed(0)
+        model, config = build_model(model_name, 'cpu')
+        config = dict(config, PRECISION="fp32")
+        loss_fn = torch.nn.CrossEntropyLoss()
+        scaler = make_grad_scaler("fp32", 'cpu')
+        batch = {'input_ids': torch.randint(config['VOCAB_SIZE'], (args.batch_size, args.block_size))}
+
+        # Training steps, the optimizer is the same for both modes
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+        eager_step = seconds_per_step(lambda: train_step(model, batch, optimizer, config, loss_fn, scaler), args.train_steps)
+        compiled_model, compile_seconds = compile_model(model, batch['input_ids'][:, :-1])
+        compiled_step = seconds_per_step(lambda: train_step(compiled_model, batch, optimizer, config, loss_fn, scaler), args.train_steps)
+        report(f"{model_name} train step", compile_seconds, eager_step, compiled_step)
+
+        # Decoding steps, CausalGPT2 decodes through its KV cache and has no next_token_logits step to export
+        if not hasattr(model, 'next_token_logits'):
+            continue
+        model.eval()
+        last_tokens = torch.randint(config['VOCAB_SIZE'], (args.decode_batch_size,))
+        positions = torch.full((args.decode_batch_size,), 10)
+        with torch.no_grad():
+            eager_step = seconds_per_step(lambda: model.next_token_logits(last_tokens, positions), args.decode_steps)
+        path = os.path.join(tempfile.mkdtemp(), f"{model_name}_decoder.pt2")
+        export_seconds = export_decoder(model, path, aot_compile=not args.no_aot_compile)
+        decoder = load_decoder(path, model)
+        compiled_step = seconds_per_step(lambda: decoder.next_token_logits(last_tokens, positions), args.decode_steps)
+        report(f"{model_name} decode step", export_seconds, eager_step, compiled_step)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Training throughput of DistributedDataParallel on CPU (gloo) for 1/2/4/8 ranks. Every rank trains on its own
+random batches of --batch-size windows of --block-size tokens and gets os.cpu_count() // ranks threads; the
+reported tokens/sec count the tokens of all the ranks.
+
+    python benchmark_ddp.py --models GPT2FromScratch Transformer21MFinalSingleLayer --ranks 1 2 4 8
+"""
+
+import time
+import argparse
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from models import MODEL_CLASSES, build_model
+from training import train_step
+from precision import make_grad_scaler
+from distributed import launch
+
+
+def _benchmark_rank(rank, world_size, model_name, args):
+    torch.manual_seed(rank)
+    model, config = build_model(model_name, 'cpu')
+    config = dict(config, PRECISION="fp32")
+    model = DistributedDataParallel(model.train())
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    scaler = make_grad_scaler("fp32", 'cpu')
+    batch = {'input_ids': torch.randint(config['VOCAB_SIZE'], (args.batch_size, args.block_size + 1))}
+
+    for _ in range(args.warmup_steps):
+        train_step(model, batch, optimizer, config, loss_fn, scaler)
+    dist.barrier()
+    start_time = time.perf_counter()
+    for _ in range(args.n_steps):
+        train_step(model, batch, optimizer, config, loss_fn, scaler)
+    dist.barrier()
+    elapsed = time.perf_counter() - start_time
+
+    if rank == 0:
+        tokens = world_size * args.n_steps * args.batch_size * args.block_size
+        print(f"{model_name:>32}{world_size:>7}{torch.get_num_threads():>9}{elapsed / args.n_steps:>10.3f}{tokens / elapsed:>14.0f}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DDP (gloo) training tokens/sec on CPU for several numbers of ranks.")
+    parser.add_argument("--models", nargs="+", default=sorted(MODEL_CLASSES), choices=sorted(MODEL_CLASSES))
+    parser.add_argument("--ranks", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch-size", type=int, default=8, help="Windows per rank and step")
+    parser.add_argument("--block-size", type=int, default=128)
+    parser.add_argument("--warmup-steps", type=int, default=2)
+    parser.add_argument("--n-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'model':>32}{'ranks':>7}{'threads':>9}{'s/step':>10}{'tokens/s':>14}")
+    for model_name in args.models:
+        for world_size in args.ranks:
+            launch(_benchmark_rank, world_size, args=(model_name, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measures how fast the DataLoader alone delivers training batches (the model is stubbed out: batches are
+only moved to the device) for several loader settings, and compares it with the training steps/sec of the
+model on batches of the same shape. If the loader is slower than the model, training is input bound.
+
+    python benchmark_loader.py --model GPT2FromScratch --tokenizer custom_tokenizer --num-workers 0 2 4
+    python benchmark_loader.py --model GPT2FromScratch --shards-dir /kaggle/working/token_shards --split train
+"""
+
+import time
+import argparse
+
+import torch
+from torch.utils import data
+from datasets import load_dataset
+from transformers import AutoTokenizer
+
+from models import MODEL_CLASSES, build_model
+from training import train_step
+from precision import make_grad_scaler
+from token_shards import TokenShardDataset
+from tokenization import tokenize_dataset
+from batching import DevicePrefetcher, loader_settings
+
+
+def build_dataset(args, tokenizer):
+    if args.shards_dir is not None:
+        shards = TokenShardDataset(args.shards_dir, args.split, tokenizer, args.block_size)
+        return data.Subset(shards, range(min(args.n_stories, len(shards))))
+    stories = load_dataset("roneneldan/TinyStories", split=f"{args.split}[:{args.n_stories}]")
+    dataset = tokenize_dataset(stories, tokenizer, args.block_size, args.cache_dir)
+    dataset.set_format(type='torch', columns=['input_ids'])
+    return dataset
+
+
+def loader_batches_per_sec(loader, device, n_batches):
+    """
+    Returns (seconds until the first batch, batches/sec afterwards) of loader with a stubbed model.
+    """
+    start_time = time.perf_counter()
+    batches = iter(DevicePrefetcher(loader, device))
+    next(batches)
+    first_batch_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    n_done = 0
+    for batch in batches:
+        # Stands in for the model: wait until the batch has really arrived on the device
+        batch['input_ids'].sum().item()
+        n_done += 1
+        if n_done == n_batches:
+            break
+    return first_batch_time, n_done / (time.perf_counter() - start_time)
+
+
+def model_steps_per_sec(model, batch, config, n_steps):
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=config['PAD_TOKEN_ID'])
+    scaler = make_grad_scaler(config['PRECISION'], config['DEVICE'])
+    batch = {'input_ids': batch['input_ids'].to(config['DEVICE'])}
+    train_step(model, batch, optimizer, config, loss_fn, scaler)  # warm-up
+    start_time = time.perf_counter()
+    for _ in range(n_steps):
+        loss = train_step(model, batch, optimizer, config, loss_fn, scaler)
+    loss.item()
+    return n_steps / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DataLoader throughput with the model stubbed out vs model steps/sec.")
+    parser.add_argument("--model", required=True, choices=sorted(MODEL_CLASSES))
+    parser.add_argument("--tokenizer", default="custom_tokenizer")
+    parser.add_argument("--shards-dir", default=None, help="Read token_shards.py shards instead of tokenizing TinyStories")
+    parser.add_argument("--split", default="validation")
+    parser.add_argument("--n-stories", type=int, default=20000)
+    parser.add_argument("--cache-dir", default="tokenized_cache")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--block-size", type=int, default=128)
+    parser.add_argument("--num-workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--prefetch-factor", type=int, default=4)
+    parser.add_argument("--n-batches", type=int, default=200)
+    parser.add_argument("--n-steps", type=int, default=20)
+    parser.add_argument("--precision", default="fp32")
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    dataset = build_dataset(args, tokenizer)
+
+    print(f"{'workers':>8}{'pinned':>8}{'first batch s':>15}{'batches/s':>12}")
+    results = []
+    for num_workers in args.num_workers:
+        for pin_memory in sorted({False, args.device.startswith('cuda')}):
+            config = {'NUM_WORKERS': num_workers, 'PIN_MEMORY': pin_memory, 'PERSISTENT_WORKERS': False, 'PREFETCH_FACTOR': args.prefetch_factor}
+            loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True, **loader_settings(config))
+            first_batch_time, batches_per_sec = loader_batches_per_sec(loader, args.device, args.n_batches)
+            results.append(batches_per_sec)
+            print(f"{num_workers:>8}{str(pin_memory):>8}{first_batch_time:>15.2f}{batches_per_sec:>12.1f}")
+
+    model, config = build_model(args.model, args.device)
+    config = dict(config, DEVICE=args.device, PRECISION=args.precision, PAD_TOKEN_ID=tokenizer.pad_token_id)
+    steps_per_sec = model_steps_per_sec(model.train(), next(iter(data.DataLoader(dataset, batch_size=args.batch_size))), config, args.n_steps)
+    print(f"Model training steps/s on {args.device}: {steps_per_sec:.1f}")
+    bound = "input" if max(results) < steps_per_sec else "compute"
+    print(f"Best loader setting delivers {max(results):.1f} batches/s: training is {bound} bound")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Compares a trained fp32 checkpoint with its dynamic int8 copy on CPU: generation latency, validation
+forward latency, checkpoint size, weight memory and validation cross-entropy on the same batches.
+
+    python benchmark_quantization.py --model Transformer21MFinalSingleLayer --checkpoint custom-21_good.pt --tokenizer custom_tokenizer
+"""
+
+import io
+import time
+import argparse
+
+import torch
+from torch.utils import data
+from datasets import load_dataset
+from transformers import AutoTokenizer
+
+from models import MODEL_CLASSES, load_checkpoint_model
+from quantization import quantize_model
+
+prompts = [
+    "In a bustling city filled with secrets, a shadow loomed.",
+    "High in the mountains, a lone traveler braved the storm.",
+    "Beneath the waves, in a hidden underwater kingdom, life thrived.",
+    "It was a quiet night until the distant howls broke the silence.",
+    "In a world where dragons flew free, danger was never far.",
+]
+
+
+def state_dict_bytes(value):
+    # Bytes held by the tensors of a state dict (quantized Linear layers store (weight, bias) tuples)
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(state_dict_bytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(state_dict_bytes(v) for v in value)
+    return 0
+
+
+def checkpoint_bytes(model):
+    checkpoint = io.BytesIO()
+    torch.save({'model_state_dict': model.state_dict()}, checkpoint)
+    return checkpoint.tell()
+
+
+def load_val_batches(tokenizer, config, n_batches, batch_size):
+    # Same tokenization as tokenize_function in the training scripts, fixed order so both models see the same batches
+    val_dataset = load_dataset("roneneldan/TinyStories", split=f"validation[:{n_batches * batch_size}]")
+    val_dataset = val_dataset.map(
+        lambda examples: tokenizer(examples["text"], padding="max_length", truncation=True, max_length=config['BLOCK_SIZE']),
+        batched=True
+    )
+    val_dataset.set_format(type='torch', columns=['input_ids'])
+    return list(data.DataLoader(val_dataset, batch_size=batch_size, shuffle=False))
+
+
+@torch.no_grad()
+def validation_metrics(model, val_batches, config):
+    # Cross-entropy per real target token (same loss as eval_model) and mean forward time per batch
+    total_loss, total_tokens, elapsed = 0.0, 0, 0.0
+    for batch in val_batches:
+        s_val = batch['input_ids']
+        t_val = s_val[:, 1:].reshape(-1)
+        s_val = s_val[:, :-1]
+        start_time = time.perf_counter()
+        val_logits = model(s_val)
+        elapsed += time.perf_counter() - start_time
+        total_loss += torch.nn.functional.cross_entropy(val_logits.reshape(-1, config['VOCAB_SIZE']), t_val, ignore_index=config['PAD_TOKEN_ID'], reduction='sum').item()
+        total_tokens += (t_val != config['PAD_TOKEN_ID']).sum().item()
+    return total_loss / total_tokens, 1000 * elapsed / len(val_batches)
+
+
+@torch.no_grad()
+def generation_ms_per_token(model, tokenizer, config):
+    model.generate(tokenizer.encode(prompts[0], return_tensors="pt"), max_new_tokens=5)  # warm-up
+    start_time = time.perf_counter()
+    for prompt in prompts:
+        model.generate(tokenizer.encode(prompt, return_tensors="pt"), max_new_tokens=config['MAX_OUT_TOKENS'])
+    return 1000 * (time.perf_counter() - start_time) / (len(prompts) * config['MAX_OUT_TOKENS'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fp32 vs dynamic int8 inference on CPU.")
+    parser.add_argument("--model", required=True, choices=sorted(MODEL_CLASSES))
+    parser.add_argument("--checkpoint", required=True)
+    parser.add_argument("--tokenizer", default="custom_tokenizer")
+    parser.add_argument("--val-batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    model, config = load_checkpoint_model(args.checkpoint, args.model, device='cpu')
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    config['PAD_TOKEN_ID'] = tokenizer.pad_token_id
+    val_batches = load_val_batches(tokenizer, config, args.val_batches, args.batch_size)
+
+    results = {}
+    for name, benchmark_model in [("fp32", model), ("int8", quantize_model(model))]:
+        val_loss, forward_ms = validation_metrics(benchmark_model, val_batches, config)
+        results[name] = {
+            "val_loss": val_loss,
+            "forward_ms_per_batch": forward_ms,
+            "generate_ms_per_token": generation_ms_per_token(benchmark_model, tokenizer, config),
+            "checkpoint_mb": checkpoint_bytes(benchmark_model) / 2**20,
+            "weights_mb": state_dict_bytes(benchmark_model.state_dict()) / 2**20,
+        }
+
+    print(f"{'':24}{'fp32':>12}{'int8':>12}")
+    for metric in results["fp32"]:
+        print(f"{metric:24}{results['fp32'][metric]:12.3f}{results['int8'][metric]:12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Builds the word vocabulary (vocab_dict_v2) from TinyStories.
+
+Stories are read in chunks of --chunk-size rows, so the text column is never materialized, and counted by
+--num-workers processes. Every worker returns the counts of its chunk, which are merged into the running
+total. With --max-counters the counts are kept as a Misra-Gries heavy-hitter summary of that many words:
+memory stays bounded and every word seen more than (total word count / max_counters) times is still kept.
+
+The result is saved with DatasetDict.save_to_disk in the layout the training scripts load from VOCAB_DIRNAME:
+'train' holds the 'word' and 'index' columns, 'validation' the validation stories.
+
+    python build_vocab.py --out-dir /kaggle/working/vocab_dict_v2 --vocab-size 9996 --num-workers 4
+"""
+
+import re
+import time
+import random
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+from datasets import load_dataset, Dataset, DatasetDict
+from transformers import AutoTokenizer
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+# Set in every worker process by _init_worker
+_worker_tokenizer = None
+
+
+def preprocess_text(text):
+    # Same words as the old nltk version, which removed the punctuation sentence by sentence and joined the
+    # stripped sentences with single spaces. Whitespace is collapsed the same way, otherwise newlines would
+    # become 'Ċ' word pieces that the Whitespace pre-tokenizer of the training tokenizer never produces
+    return " ".join(PUNCTUATION_PATTERN.sub("", text.lower()).split())
+
+
+def count_words(texts, tokenizer):
+    """
+    Counts the base tokenizer's word pieces (without the 'Ġ' space marker) of every text.
+    """
+    counts = Counter()
+    encodings = tokenizer.backend_tokenizer.encode_batch([preprocess_text(text) for text in texts], add_special_tokens=False)
+    for encoding in encodings:
+        # Whitespace is already collapsed, so every piece but the marker is a non-empty word
+        counts.update(token.replace('Ġ', '') for token in encoding.tokens if token != 'Ġ')
+    return counts
+
+
+def prune_counts(counts, max_counters):
+    """
+    Misra-Gries reduction of counts to at most max_counters words: the (max_counters + 1)-th largest count
+    is subtracted from every word and the words left at zero are dropped. Summaries pruned this way can be
+    added together and pruned again.
+    """
+    if max_counters is None or len(counts) <= max_counters:
+        return counts
+    threshold = sorted(counts.values(), reverse=True)[max_counters]
+    return Counter({word: count - threshold for word, count in counts.items() if count > threshold})
+
+
+def _init_worker(tokenizer_name):
+    global _worker_tokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _count_chunk(args):
+    dataset, start, end, max_counters = args
+    return prune_counts(count_words(dataset[start:end]["text"], _worker_tokenizer), max_counters)
+
+
+def count_dataset(dataset, tokenizer_name, num_workers=1, chunk_size=10000, max_counters=None):
+    """
+    Word counts of all the stories of dataset, counted chunk by chunk in num_workers processes.
+    """
+    chunks = [(dataset, start, min(start + chunk_size, len(dataset)), max_counters) for start in range(0, len(dataset), chunk_size)]
+    counts = Counter()
+    with Pool(num_workers, initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+        for n_done, partial_counts in enumerate(pool.imap_unordered(_count_chunk, chunks), start=1):
+            counts.update(partial_counts)
+            counts = prune_counts(counts, max_counters)
+            print(f"Counted {n_done}/{len(chunks)} chunks, {len(counts)} distinct words", end="\r")
+    print()
+    return counts
+
+
+def build_vocab_dataset(dataset_dict, tokenizer_name, vocab_size=9996, num_samples=None, num_workers=1, chunk_size=10000, max_counters=None):
+    """
+    vocab_dict_v2 DatasetDict with the vocab_size most frequent words of dataset_dict['train'].
+    """
+    train_dataset = dataset_dict['train']
+    if num_samples:
+        # Randomly sample num_samples stories
+        train_dataset = train_dataset.select(random.sample(range(len(train_dataset)), num_samples))
+
+    counts = count_dataset(train_dataset, tokenizer_name, num_workers, chunk_size, max_counters)
+    vocab_dict = {word: idx for idx, (word, _) in enumerate(counts.most_common(vocab_size))}
+
+    return DatasetDict({
+        'train': Dataset.from_dict({'word': list(vocab_dict.keys()), 'index': list(vocab_dict.values())}),
+        'validation': dataset_dict['validation']
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build vocab_dict_v2 from TinyStories with parallel word counts.")
+    parser.add_argument("--out-dir", required=True)
+    parser.add_argument("--vocab-size", type=int, default=9996)
+    parser.add_argument("--base-tokenizer", default="roneneldan/TinyStories-1Layer-21M", help="GPT-2 style tokenizer splitting the words")
+    parser.add_argument("--num-samples", type=int, default=None, help="Only count a random sample of the stories")
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--max-counters", type=int, default=None, help="Bound the counts to this many words (approximate)")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    vocab_dataset = build_vocab_dataset(
+        load_dataset("roneneldan/TinyStories"), args.base_tokenizer,
+        vocab_size=args.vocab_size,
+        num_samples=args.num_samples,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size,
+        max_counters=args.max_counters
+    )
+    vocab_dataset.save_to_disk(args.out_dir)
+    print(f"Saved {len(vocab_dataset['train'])} words to {args.out_dir} in {time.perf_counter() - start_time:.0f} s")
+    print(vocab_dataset['train'][:10])  # Print the first 10 tokens from the vocabulary dataset
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import glob
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def rng_state():
+    # Every random number generator the training loop draws from (shuffling, dropout, sampling)
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_cpu(state):
+    """
+    Copy of a (nested) state dict with every tensor copied to the CPU, so it can be written while training
+    goes on and updates the original tensors in place.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointManager:
+    """
+    Writes training checkpoints to directory as checkpoint_<step>.pt and keeps the keep_last newest ones.
+
+    save() copies the state to the CPU and returns; torch.save runs on a background thread, into a temporary
+    file renamed over the final name once complete, so a crash never leaves a truncated checkpoint behind.
+    """
+    def __init__(self, directory, keep_last=3):
+        if keep_last < 1:
+            # Keeping none would delete every checkpoint right after writing it; use CHECKPOINT_DIR=None instead
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}")
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def checkpoints(self):
+        # Oldest first, the step is zero-padded in the file name
+        return sorted(glob.glob(os.path.join(self.directory, "checkpoint_*.pt")))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load_latest(self, device='cpu'):
+        # None if nothing was saved yet. The checkpoints hold Python and numpy RNG states, so they are
+        # not loadable with weights_only; only load checkpoints written by this class.
+        path = self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=device, weights_only=False)
+
+    def save(self, state, step):
+        if self.error is not None:
+            raise RuntimeError("Writing an earlier checkpoint failed") from self.error
+        self.queue.put((to_cpu(state), step))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, step = item
+            path = os.path.join(self.directory, f"checkpoint_{step:09d}.pt")
+            try:
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                for old_path in self.checkpoints()[:-self.keep_last]:
+                    os.remove(old_path)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        # Waits for the pending writes
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+
+class BestWeights:
+    """
+    Snapshot of the weights with the best validation loss so far, in CPU buffers allocated once (pinned
+    when the model is on a GPU). Every improvement copies the weights into the same buffers instead of
+    deep-copying the model, and restore() loads them back.
+    """
+    def __init__(self, model):
+        state_dict = model.state_dict()
+        self.on_gpu = any(tensor.is_cuda for tensor in state_dict.values())
+        self.buffers = {name: torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self.on_gpu) for name, tensor in state_dict.items()}
+        self.saved = False
+
+    def update(self, model):
+        for name, tensor in model.state_dict().items():
+            self.buffers[name].copy_(tensor.detach(), non_blocking=True)
+        if self.on_gpu:
+            # The copies have to be done before the next steps change the weights
+            torch.cuda.synchronize()
+        self.saved = True
+
+    def restore(self, model):
+        model.load_state_dict(self.buffers)
+
+    def state_dict(self):
+        return self.buffers if self.saved else None
+
+    def load_state_dict(self, state_dict):
+        if state_dict is not None:
+            for name, tensor in state_dict.items():
+                self.buffers[name].copy_(tensor)
+            self.saved = True
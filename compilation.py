@@ -0,0 +1,104 @@
+import time
+import torch
+import torch.nn as nn
+from torch.export import Dim
+from precision import autocast_context
+
+
+def compile_model(model, sources, precision="fp32", dynamic=None):
+    """
+    torch.compile(model) for training, compiled right away by a forward and backward pass in precision on the
+    (B, T) batch sources so that the compile time is not hidden in the first steps. Returns (model, compile
+    seconds): the compiled module, or model itself when torch.compile is unavailable or fails on this platform.
+
+    dynamic=None compiles for the shape of sources and recompiles with dynamic shapes once a batch of another
+    shape shows up (e.g. the last, smaller batch); pass dynamic=True when every batch has its own length
+    (BUCKET_BY_LENGTH).
+    """
+    if not hasattr(torch, 'compile'):
+        print("torch.compile is not available, training in eager mode.")
+        return model, 0.0
+    start_time = time.perf_counter()
+    try:
+        compiled_model = torch.compile(model, dynamic=dynamic)
+        with autocast_context(precision, sources.device):
+            logits = compiled_model(sources)
+        logits.float().sum().backward()
+    except Exception as error:
+        print(f"torch.compile failed, training in eager mode: {error}")
+        return model, 0.0
+    finally:
+        model.zero_grad(set_to_none=True)
+    return compiled_model, time.perf_counter() - start_time
+
+
+class DecodeStep(nn.Module):
+    # next_token_logits of model as the forward of a module, the function the decoding loops call every step
+    def __init__(self, model):
+        super(DecodeStep, self).__init__()
+        self.model = model
+
+    def forward(self, last_tokens, positions):
+        return self.model.next_token_logits(last_tokens, positions)
+
+
+def export_decoder(model, path, aot_compile=True):
+    """
+    Exports model.next_token_logits to path with torch.export, as an AOTInductor compiled package when
+    aot_compile is set (and possible), as a plain exported program otherwise. Returns the export seconds.
+
+    The models predict the next token from the newest token and its position alone, so a decoding step always
+    has the shapes (B,) -> (B, VOCAB_SIZE) however long the sequences grow: only the batch dimension is
+    dynamic, for the rows generate_batch drops once they are done.
+    """
+    if not hasattr(model, 'next_token_logits'):
+        raise ValueError(f"{type(model).__name__} has no next_token_logits decoding step to export")
+    model.eval()
+    device = next(model.parameters()).device
+    example = (torch.zeros(2, dtype=torch.long, device=device), torch.zeros(2, dtype=torch.long, device=device))
+    batch = Dim.DYNAMIC
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        exported = torch.export.export(DecodeStep(model), example, dynamic_shapes=({0: batch}, {0: batch}))
+        if aot_compile:
+            try:
+                torch._inductor.aoti_compile_and_package(exported, package_path=path)
+                return time.perf_counter() - start_time
+            except Exception as error:
+                print(f"AOTInductor compilation failed, saving the uncompiled exported program: {error}")
+        torch.export.save(exported, path)
+    return time.perf_counter() - start_time
+
+
+class ExportedDecoder:
+    """
+    Decoding step loaded from an export_decoder artifact, with the next_token_logits interface of the models,
+    so it can replace the model in generate_batch and generate_speculative.
+    """
+    def __init__(self, step):
+        self.step = step
+
+    def eval(self):
+        return self
+
+    @torch.no_grad()
+    def next_token_logits(self, last_tokens, positions):
+        return self.step(last_tokens, positions)
+
+
+def load_decoder(path, model=None):
+    """
+    ExportedDecoder of the artifact at path. Falls back to model (eager) when the artifact cannot be
+    loaded here, e.g. an AOTInductor package built for another platform or PyTorch version.
+    """
+    try:
+        return ExportedDecoder(torch._inductor.aoti_load_package(path))
+    except Exception:
+        pass
+    try:
+        return ExportedDecoder(torch.export.load(path).module())
+    except Exception as error:
+        if model is None:
+            raise
+        print(f"Could not load the decoder {path}, generating with the eager model: {error}")
+        return model
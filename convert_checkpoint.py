@@ -0,0 +1,38 @@
+"""
+Converts a GPT2FromScratch checkpoint (e.g. custom-21M.pt) to CausalGPT2, see convert_gpt2_state_dict. The
+optimizer state is dropped (the fused qkv weights are new parameters for it); fine-tune the converted model
+before using it, its attention is causal over time where GPT2FromScratch's ran across the batch.
+
+    python convert_checkpoint.py /kaggle/working/model/custom-21M.pt /kaggle/working/model/custom-21M-causal.pt
+"""
+
+import argparse
+
+import torch
+
+from models import build_model, convert_gpt2_state_dict, load_model_state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT2FromScratch checkpoint to CausalGPT2 checkpoint.")
+    parser.add_argument("checkpoint", help="torch.save({'model_state_dict': ...}) file of a GPT2FromScratch model")
+    parser.add_argument("output", help="Converted checkpoint, loadable with load_checkpoint_model(..., 'CausalGPT2')")
+    parser.add_argument("--block-size", type=int, default=None, help="BLOCK_SIZE of the model, MODEL_CONFIGS by default")
+    args = parser.parse_args()
+
+    config = {} if args.block_size is None else {"BLOCK_SIZE": args.block_size}
+    model, config = build_model("CausalGPT2", 'cpu', config)
+    checkpoint = torch.load(args.checkpoint, map_location='cpu', weights_only=True)
+    state_dict = convert_gpt2_state_dict(checkpoint['model_state_dict'], config['BLOCK_SIZE'])
+    # Fails on checkpoints of other models or hyperparameters before anything is written
+    load_model_state(model, state_dict, "CausalGPT2")
+
+    torch.save({'model_state_dict': model.state_dict(),
+                # Older checkpoints were all trained in fp32
+                'precision': checkpoint.get('precision', "fp32"),
+                }, args.output)
+    print(f"Converted {args.checkpoint} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
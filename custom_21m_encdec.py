@@ -21,6 +21,8 @@ from torch.utils import data
 from collections import Counter
 from google.api_core import retry
 from torch.nn import functional as F
+from generation import TokenBuffer, generate_batch, stream_text, sample_next_token
+from build_vocab import build_vocab_dataset
 import google.generativeai as gemini_ai
 from transformers import GPT2TokenizerFast
 from transformers import BitsAndBytesConfig
@@ -40,12 +42,6 @@ from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, decoders,
 
 user_secrets = UserSecretsClient()
 
-"""### Wandb"""
-
-wandb_api_key = user_secrets.get_secret("WANDB_API_KEY")
-
-wandb.login(key=wandb_api_key)
-
 """### Gemini"""
 
 gemini_api_key = user_secrets.get_secret("GEMINI_API_KEY")
@@ -73,11 +69,40 @@ config = {
     "DROPOUT": 0.1,
     "MAX_LENGTH": 512,
     "MAX_OUT_TOKENS": 200,
-    "EVAL_ITER": 100,
+    "SAMPLING": {"do_sample": True, "temperature": 1.0, "top_k": None, "top_p": 1.0, "repetition_penalty": 1.0},
+    "PRECISION": "fp32",  # "fp32", "bf16" (CPU or GPU) or "fp16" (GPU only)
+    "TOKEN_SHARDS_DIR": None,  # Directory written by token_shards.py, None tokenizes the dataset on every run
+    "PACK_SEQUENCES": False,  # Join the stories with <eos> into full BLOCK_SIZE windows instead of padding every story
+    "DOCUMENT_MASK": False,  # With PACK_SEQUENCES, also return document_ids (only CausalGPT2 takes them, train_model raises otherwise)
+    "BUCKET_BY_LENGTH": False,  # Batch stories of similar length and pad only to the longest story of the batch
+    "SPLIT_SEED": 42,  # Fixed train/validation split, so the tokenized splits can be reused between runs
+    "NUM_PROC": os.cpu_count(),  # Tokenization worker processes
+    "CACHE_DIR": "/kaggle/working/tokenized_cache",
+    "STREAMING": False,  # Stream, tokenize and pack the whole train split on the fly instead of a used_dataset_size subset
+    "SHUFFLE_BUFFER": 10000,  # Stories held in the streaming shuffle buffer (per loader worker)
+    "NUM_WORKERS": 2,  # DataLoader worker processes, 0 loads the batches in the training process
+    "PIN_MEMORY": torch.cuda.is_available(),  # Page-locked batches, copied to the GPU asynchronously
+    "PERSISTENT_WORKERS": True,  # Keep the workers alive between epochs and evaluations
+    "PREFETCH_FACTOR": 4,  # Batches prepared in advance by every worker
+    "COMPILE": False,  # torch.compile the model for training, falls back to eager mode where it is not supported
+    "EXPORT_DECODER": False,  # Export next_token_logits (AOTInductor) after training and generate the batches with it
+    "DDP_WORLD_SIZE": 1,  # CPU training processes (DistributedDataParallel over gloo), 1 trains in this process
+    "EVAL_ITER": 100,  # Validation batches per evaluation, None evaluates the whole validation set
+    "EVAL_EVERY_STEPS": None,  # Evaluate (and count PATIENCE) every EVAL_EVERY_STEPS steps, None evaluates after every epoch
+    "METRICS_SINKS": ["wandb"],  # "wandb" and/or "jsonl", only "jsonl" runs offline
+    "METRICS_PATH": "/kaggle/working/metrics.jsonl",  # Written by the "jsonl" sink
+    "LOG_EVERY_STEPS": 50,  # Training metrics are read back from the device and logged every LOG_EVERY_STEPS steps
+    "LOG_EVERY_SECS": 10,  # ... or every LOG_EVERY_SECS seconds, whichever comes first
     "LR": 3e-4,
-    "BATCH_SIZE": 32,
+    "BATCH_SIZE": 32,  # Stories per optimizer step
+    "MICRO_BATCH_SIZE": None,  # Stories per forward/backward pass, gradients are accumulated over the BATCH_SIZE stories
+    "LOSS_CHUNK_SIZE": None,  # Target positions per vocabulary projection chunk, None computes all the logits at once
     "EPOCHS": 1,
     "PATIENCE": 3,
+    "CHECKPOINT_DIR": "/kaggle/working/checkpoints",  # Full training state for RESUME, None disables the checkpoints
+    "CHECKPOINT_EVERY_STEPS": 1000,  # Also checkpointed after every epoch
+    "KEEP_CHECKPOINTS": 3,  # Newest checkpoints kept on disk, at least 1
+    "RESUME": False,  # Continue from the latest checkpoint of CHECKPOINT_DIR
     "MODEL_NAME": "custom-21",
     "WORKING_DIR": "/kaggle/working",
     "VOCAB_DIRNAME": "/kaggle/input/vocab-dict-v2/vocab_dict_v2",
@@ -89,11 +114,15 @@ assert config['EMB_SIZE'] % config['N_ATTENTION_HEADS'] == 0
 
 used_dataset_size = 100000
 
-wandb.init(
-    project='custom-21M',
-    config=config
-)
-text_table = wandb.Table(columns=['epoch', 'loss', 'predicted text'])
+if "wandb" in config['METRICS_SINKS']:
+    # The key is only needed (and looked up) when logging to wandb
+    wandb_api_key = user_secrets.get_secret("WANDB_API_KEY")
+    wandb.login(key=wandb_api_key)
+    wandb.init(
+        project='custom-21M',
+        config=config
+    )
+    text_table = wandb.Table(columns=['epoch', 'loss', 'predicted text'])
 
 """## Config for training"""
 
@@ -106,52 +135,14 @@ load_df = False
 ## Download the dataset
 """
 
-dataset = load_dataset("roneneldan/TinyStories")
+dataset = load_dataset("roneneldan/TinyStories", streaming=config['STREAMING'])
 
 """## Build the Vocabulary"""
 
-# def preprocess_text(text):
-#     # Split text into sentences
-#     sentences = nltk.sent_tokenize(text)
-
-#     punctuation_pattern = r"[^\w\s]"
-
-#     # Add <SOS> and <EOS> tokens to each sentence and remove punctuation
-#     processed_sentences = [f"{re.sub(punctuation_pattern, '', sentence).strip()}" for sentence in sentences]
-
-#     # Join sentences back into a single string
-#     return " ".join(processed_sentences)
-
-# # Update the vocabulary building function to include this preprocessing
-# def build_vocabulary(dataset_dict, vocab_size=50, num_samples=None):
-#     # Initialize a counter for word frequencies
-#     word_counter = Counter()
-
-#     # Use tqdm to add a progress bar for the iteration
-#     data = dataset_dict['train']['text']
-
-#     # Randomly sample num_samples if specified
-#     if num_samples:
-#         data = random.sample(data, num_samples)
-
-#     # Tokenize and clean text using the tokenizer and update word frequencies
-#     for text in tqdm(data, desc="Building vocabulary", unit="text"):
-#         processed_text = preprocess_text(text.lower())
-#         tokens = [token.replace('Ġ', '') for token in tokenizer.tokenize(processed_text)]
-#         word_counter.update(tokens)
-
-#     # Get the most common tokens and create a vocabulary dictionary
-#     vocab_dict = {word: idx for idx, (word, _) in enumerate(word_counter.most_common(vocab_size))}
-
-#     # Convert the vocabulary dictionary to a DatasetDict
-#     vocab_dataset = DatasetDict({
-#         'train': Dataset.from_dict({'word': list(vocab_dict.keys()), 'index': list(vocab_dict.values())}),
-#         'validation': dataset_dict['validation']
-#     })
-#     return vocab_dataset
-
-# # Example usage
-# vocab_dataset = build_vocabulary(dataset, vocab_size=9996)
+# Built with build_vocab.py (streaming, multi-process word counts), from the command line:
+#   python build_vocab.py --out-dir /kaggle/working/vocab_dict_v2 --vocab-size 9996 --num-workers 4
+# or here, with the same arguments:
+# vocab_dataset = build_vocab_dataset(dataset, "roneneldan/TinyStories-1Layer-21M", vocab_size=9996, num_workers=os.cpu_count())
 # print(vocab_dataset['train'][:10])  # Print the first 10 tokens from the vocabulary dataset
 
 """## Saving the Vocabulary"""
@@ -173,82 +164,24 @@ if "[UNK]" not in custom_vocab_dict:
 
 """## Split the dataset"""
 
-sampled_dataset = dataset['train'].train_test_split(train_size=0.8, test_size=0.2)
-train_dataset, val_dataset = sampled_dataset['train'].select(range(int(0.8 * used_dataset_size))), sampled_dataset['test'].select(range(int(0.2 * used_dataset_size)))
+if not config['STREAMING']:
+    sampled_dataset = dataset['train'].train_test_split(train_size=0.8, test_size=0.2, seed=config['SPLIT_SEED'])
+    train_dataset, val_dataset = sampled_dataset['train'].select(range(int(0.8 * used_dataset_size))), sampled_dataset['test'].select(range(int(0.2 * used_dataset_size)))
 
 """# Model and tokenizer
 
 ## Model
 """
 
-
-
-class Transformer21MFinalSingleLayer(nn.Module):
-    def __init__(self, config=None):
-        super(Transformer21MFinalSingleLayer, self).__init__()
-
-        self.device = config['DEVICE']
-
-        # Embedding layer
-        self.embedding = nn.Embedding(config['VOCAB_SIZE'], config['EMB_SIZE']).to(self.device)
-
-        # Positional encoding
-        self.positional_encoding = nn.Parameter(torch.zeros(1, config['MAX_LENGTH'], config['EMB_SIZE'])).to(self.device)
-
-        encoder_layer = TransformerEncoderLayer(d_model=config['EMB_SIZE'], nhead=config['N_ATTENTION_HEADS'], dim_feedforward=config['DIM_FEEDFORWRD'], dropout=config['DROPOUT'])
-        decoder_layer = TransformerDecoderLayer(d_model=config['EMB_SIZE'], nhead=config['N_ATTENTION_HEADS'], dim_feedforward=config['DIM_FEEDFORWRD'], dropout=config['DROPOUT'])
-
-        self.transformer_encoder = TransformerEncoder(encoder_layer, num_layers=config['N_ENCODER_BLOCKS']).to(self.device)
-        self.transformer_decoder = TransformerDecoder(decoder_layer, num_layers=config['N_DECODER_BLOCKS']).to(self.device)
-
-        # Output linear layer
-        self.fc_out = nn.Linear(config['EMB_SIZE'], config['VOCAB_SIZE']).to(self.device)
-
-        self.logits = None
-
-    def forward(self, src, past_key_values=None):
-        # Move src to the correct device
-        src = src.to(self.device)
-
-        # Shift src and create tgt to be aligned in length with src
-        tgt = src.clone()
-
-        # Embedding and positional encoding
-        src = self.embedding(src) + self.positional_encoding[:, :src.size(1), :]
-        tgt = self.embedding(tgt) + self.positional_encoding[:, :tgt.size(1), :]
-
-        # Pass through the encoder
-        memory = self.transformer_encoder(src)
-
-        # Pass through the decoder
-        output = self.transformer_decoder(tgt, memory)
-
-        # Output layer to vocab logits
-        logits = self.fc_out(output)
-
-        self.logits = logits
-
-        self.block_size = config['BLOCK_SIZE']
-
-        return self.logits # Shape: (batch_size, sequence_length, vocab_size)
-
-
-    def generate(self, idx, max_new_tokens):
-        self.eval()  # Ensure the model is in evaluation mode
-        for _ in range(max_new_tokens):
-            # Crop idx to the last block_size tokens
-            idx_cond = idx[:, -self.block_size:]
-            # Get the predictions
-            logits = self(idx_cond)  # Only use logits (ignore loss)
-            # Focus only on the last time step
-            logits = logits[:, -1, :]  # (B, VOCAB_SIZE)
-            # Apply softmax to get probabilities
-            probs = F.softmax(logits, dim=-1)  # (B, VOCAB_SIZE)
-            # Sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)  # (B, 1)
-            # Append the sampled index to the running sequence
-            idx = torch.cat((idx, idx_next), dim=1)  # (B, T+1)
-        return idx
+from models import Transformer21MFinalSingleLayer
+from quantization import save_quantized_checkpoint
+from training import train_model, check_precision_parity
+from distributed import train_distributed
+from compilation import compile_model, export_decoder, load_decoder
+from token_shards import TokenShardDataset
+from tokenization import tokenize_dataset
+from streaming import StreamingPackedDataset
+from batching import PackedTokenDataset, pack_documents, LengthBucketSampler, PadCollator, sequence_lengths, loader_settings
 
 # # Define GPT-2 Architecture
 
@@ -300,13 +233,14 @@ class Transformer21MFinalSingleLayer(nn.Module):
 #         logits = self.model(x)
 #         return {'logits': logits}  # Return a dictionary with logits
 
-#     def generate(self, input_ids, max_length=50, **kwargs):
-#         output = input_ids
+#     def generate(self, input_ids, max_length=50, sampling=None, **kwargs):
+#         buffer = TokenBuffer(input_ids, max_length)
 #         for _ in range(max_length):
-#             logits = self.forward(output)['logits']
-#             next_token = torch.argmax(logits[:, -1], dim=-1).unsqueeze(-1)
-#             output = torch.cat((output, next_token), dim=1)
-#         return output
+#             logits = self.forward(buffer.tokens)['logits']
+#             # Greedy unless other sampling options are given
+#             next_token = sample_next_token(logits[:, -1], sampling or {"do_sample": False}, buffer.tokens)
+#             buffer.append(next_token)
+#         return buffer.tokens
 
 """## Tokenizer"""
 
@@ -337,23 +271,62 @@ custom_tokenizer.save_pretrained("custom_tokenizer")
 custom_tokenizer = AutoTokenizer.from_pretrained("custom_tokenizer")
 print(f"Custom tokenizer vocabulary size: {custom_tokenizer.vocab_size}")
 
-"""## Tokenize the dataset"""
+# [PAD] targets are left out of the training and validation losses
+config['PAD_TOKEN_ID'] = custom_tokenizer.pad_token_id
 
-# Tokenization function for HuggingFace dataset
-def tokenize_function(examples):
-    return custom_tokenizer(examples["text"], padding="max_length", truncation=True, max_length=config['BLOCK_SIZE'])
+"""## Tokenize the dataset"""
 
-train_dataset = train_dataset.map(tokenize_function, batched=True)
-val_dataset = val_dataset.map(tokenize_function, batched=True)
+if config['STREAMING']:
+    # The stories are shuffled in a bounded buffer, tokenized and packed in the loader workers, memory stays constant
+    train_dataset = StreamingPackedDataset(dataset['train'], custom_tokenizer, config['BLOCK_SIZE'], config['BATCH_SIZE'], shuffle_buffer=config['SHUFFLE_BUFFER'], seed=config['SPLIT_SEED'])
+    val_dataset = StreamingPackedDataset(dataset['validation'], custom_tokenizer, config['BLOCK_SIZE'], config['BATCH_SIZE'], shuffle_buffer=0)
+elif config['TOKEN_SHARDS_DIR'] is not None:
+    # Pre-tokenized memory-mapped stories, nothing to tokenize at startup
+    train_shards = TokenShardDataset(config['TOKEN_SHARDS_DIR'], 'train', custom_tokenizer, config['BLOCK_SIZE'], padding=not config['BUCKET_BY_LENGTH'])
+    val_shards = TokenShardDataset(config['TOKEN_SHARDS_DIR'], 'validation', custom_tokenizer, config['BLOCK_SIZE'], padding=not config['BUCKET_BY_LENGTH'])
+    train_dataset = data.Subset(train_shards, range(min(int(0.8 * used_dataset_size), len(train_shards))))
+    val_dataset = data.Subset(val_shards, range(min(int(0.2 * used_dataset_size), len(val_shards))))
+elif not config['PACK_SEQUENCES']:
+    # Tokenized in NUM_PROC processes and cached on (stories, tokenizer, BLOCK_SIZE), so unchanged re-runs skip it.
+    # With BUCKET_BY_LENGTH every batch is padded by PadCollator instead
+    padding = False if config['BUCKET_BY_LENGTH'] else "max_length"
+    train_dataset = tokenize_dataset(train_dataset, custom_tokenizer, config['BLOCK_SIZE'], config['CACHE_DIR'], padding=padding, num_proc=config['NUM_PROC'])
+    val_dataset = tokenize_dataset(val_dataset, custom_tokenizer, config['BLOCK_SIZE'], config['CACHE_DIR'], padding=padding, num_proc=config['NUM_PROC'])
+
+if config['PACK_SEQUENCES'] and not config['STREAMING']:
+    # Stories joined by <eos> and cut into contiguous BLOCK_SIZE windows, no position is spent on [PAD]
+    eos_token_id = custom_tokenizer.convert_tokens_to_ids('<eos>')
+    if config['TOKEN_SHARDS_DIR'] is not None:
+        train_documents = [train_shards.document(i) for i in train_dataset.indices]
+        val_documents = [val_shards.document(i) for i in val_dataset.indices]
+    else:
+        train_documents = custom_tokenizer(train_dataset["text"])["input_ids"]
+        val_documents = custom_tokenizer(val_dataset["text"])["input_ids"]
+    train_dataset = PackedTokenDataset(pack_documents(train_documents, eos_token_id), config['BLOCK_SIZE'], eos_token_id, document_ids=config['DOCUMENT_MASK'])
+    val_dataset = PackedTokenDataset(pack_documents(val_documents, eos_token_id), config['BLOCK_SIZE'], eos_token_id, document_ids=config['DOCUMENT_MASK'])
 
 """## Loading the dataset"""
 
 # Convert tokenized dataset to PyTorch tensors
-train_dataset.set_format(type='torch', columns=['input_ids'])
-val_dataset.set_format(type='torch', columns=['input_ids'])
-
-train_loader = data.DataLoader(train_dataset, batch_size=config['BATCH_SIZE'], shuffle=True)
-val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], shuffle=False)
+if config['TOKEN_SHARDS_DIR'] is None and not config['PACK_SEQUENCES'] and not config['STREAMING']:
+    train_dataset.set_format(type='torch', columns=['input_ids'])
+    val_dataset.set_format(type='torch', columns=['input_ids'])
+
+if config['STREAMING']:
+    # Shuffled by the dataset itself. New workers every epoch, they need the dataset's current epoch and position
+    train_loader = data.DataLoader(train_dataset, batch_size=config['BATCH_SIZE'], **loader_settings(config, persistent_workers=False))
+    val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], **loader_settings(config))
+elif config['BUCKET_BY_LENGTH'] and not config['PACK_SEQUENCES']:
+    # Batches of stories with similar lengths, padded to their longest story
+    pad_collate = PadCollator(config['PAD_TOKEN_ID'])
+    train_sampler = LengthBucketSampler(sequence_lengths(train_dataset), config['BATCH_SIZE'], shuffle=True)
+    # Unshuffled, so every evaluation scores the same EVAL_ITER batches (whole buckets of stories)
+    val_sampler = LengthBucketSampler(sequence_lengths(val_dataset), config['BATCH_SIZE'], shuffle=False)
+    train_loader = data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=pad_collate, **loader_settings(config))
+    val_loader = data.DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=pad_collate, **loader_settings(config))
+else:
+    train_loader = data.DataLoader(train_dataset, batch_size=config['BATCH_SIZE'], shuffle=True, **loader_settings(config))
+    val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], shuffle=False, **loader_settings(config))
 
 print(len(custom_tokenizer))
 
@@ -388,104 +361,29 @@ print(f"Total Trainable Parameters: {total_params}")
 """## Optimizer and Loss Function"""
 
 optimizer = torch.optim.Adam(model.parameters(), lr=config['LR'])
-loss_fn = torch.nn.CrossEntropyLoss()
-
-"""## Evaluation function for validation set"""
-
-@torch.no_grad()
-def eval_model(training_model: torch.nn.Module, val_loader: torch.utils.data.DataLoader):
-    training_model.eval()
-    losses = torch.zeros(config['EVAL_ITER'])
-    for k in range(config['EVAL_ITER']):
-        batch = next(iter(val_loader))  # Get the batch as a single value
-        s_val = batch['input_ids'].to(config['DEVICE'])  # Access 'input_ids' from the batch
-        t_val = s_val[:, 1:].clone()  # Shift for language model prediction
-        s_val = s_val[:, :-1]  # Remove last token from source
-
-        # Forward pass through the model
-        val_output = training_model(s_val)
-        val_logits = val_output  # Access logits from the model's output
-
-        # Reshape logits and targets
-        val_logits = val_logits.view(s_val.size(0) * s_val.size(1), config['VOCAB_SIZE'])
-        t_val = t_val.view(s_val.size(0) * s_val.size(1))
-
-        # Compute the loss
-        losses[k] = torch.nn.functional.cross_entropy(val_logits, t_val).item()
-
-    training_model.train()
-    return losses.mean()
-
-"""## Training function"""
-
-def train_model(model, train_loader, val_loader, optimizer, config, loss_fn):
-    """
-    Trains the model and logs the training and validation losses, with progress tracking using tqdm.
-    """
-
-    best_val_loss = float('inf')
-    patience_counter = 0
-
-    try:
-        for epoch in range(config['EPOCHS']):
-            model.train()
-            epoch_loss = 0
-
-            epoch_progress = tqdm(train_loader, desc=f"Training Epoch {epoch+1}/{config['EPOCHS']}: ", leave=False)
-
-            for b_idx, batch in enumerate(epoch_progress):
-                sources = batch['input_ids'].to(config['DEVICE'])
-                targets = sources[:, 1:].clone().to(config['DEVICE'])  # Shift for language model prediction
-                sources = sources[:, :-1]  # Remove last token from source
-                logits = model(sources)  # Access logits from the model output
-
-                # Get the actual batch size and sequence length
-                batch_size = sources.size(0)
-                seq_length = sources.size(1)
-
-                # Reshape logits and targets
-                # logits = logits.view(batch_size * seq_length, config['VOCAB_SIZE'])
-                # targets = targets.view(batch_size * seq_length)
-                logits = logits.view(-1, config['VOCAB_SIZE'])  # shape: (batch_size * seq_length, vocab_size)
-                targets = targets.view(-1)
-
-                loss = loss_fn(logits, targets)
-                wandb.log({"loss": loss.item()})
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                epoch_loss += loss.item()
-                avg_loss = epoch_loss / (b_idx + 1)
-                epoch_progress.set_postfix(training_loss=avg_loss)
-
-            avg_epoch_loss = epoch_loss / len(train_loader)
-            print(f"Epoch {epoch+1}/{config['EPOCHS']} completed with average training loss: {avg_epoch_loss}")
-
-            val_loss = eval_model(model, val_loader)
-            print(f"Validation loss after {epoch+1} epochs: {val_loss}")
-            wandb.log({"val_loss": val_loss})
-
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                patience_counter = 0
-                print(f"New best validation loss: {val_loss}.")
-            else:
-                patience_counter += 1
-                print(f"No improvement in validation loss. Patience counter: {patience_counter}")
-
-            if patience_counter >= config['PATIENCE']:
-                print("Early stopping triggered.")
-                break
-
-    except KeyboardInterrupt:
-        print("Training interrupted.")
-    print("Training completed.")
+loss_fn = torch.nn.CrossEntropyLoss(ignore_index=config['PAD_TOKEN_ID'])
+
+"""## Precision check
+
+Short fp32 vs reduced precision run from the same weights and batches before the real training.
+"""
+
+if not load_model and config['PRECISION'] != "fp32":
+    check_precision_parity(model, train_loader, optimizer, config, loss_fn, n_steps=20)
 
 """## Running the training loop"""
 
-if not load_model:
-    train_model(model, train_loader, val_loader, optimizer, config, loss_fn)
+if not load_model and config['DDP_WORLD_SIZE'] > 1:
+    # Every rank trains on its own shard of train_dataset with BATCH_SIZE stories per step
+    train_distributed(model, train_dataset, val_dataset, optimizer, config, loss_fn, config['DDP_WORLD_SIZE'], collate_fn=train_loader.collate_fn)
+elif not load_model:
+    training_model = model
+    if config['COMPILE']:
+        # Compiled up front on a batch of the loader, variable length batches are compiled with dynamic shapes
+        example_sources = next(iter(train_loader))['input_ids'][:, :-1].to(config['DEVICE'])
+        training_model, compile_seconds = compile_model(model, example_sources, config['PRECISION'], dynamic=True if config['BUCKET_BY_LENGTH'] else None)
+        print(f"Compiled the model in {compile_seconds:.1f} s")
+    train_model(training_model, train_loader, val_loader, optimizer, config, loss_fn)
 
 """## Saving the model"""
 
@@ -496,17 +394,30 @@ if not load_model:
         os.mkdir(model_req_path)
 
     torch.save({'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict()
+                'optimizer_state_dict': optimizer.state_dict(),
+                'precision': config['PRECISION']
                 }, model_req_path+'/'+config['MODEL_NAME']+'.pt')
 
     print("Model saved!")
 
+    # Dynamic int8 copy for CPU inference, loaded with load_quantized_model
+    save_quantized_checkpoint(model, "Transformer21MFinalSingleLayer", config, model_req_path+'/'+config['MODEL_NAME']+'-int8.pt')
+
+    print("Int8 model saved!")
+
+    if config['EXPORT_DECODER']:
+        # Decoding step for generate_batch, loaded with load_decoder
+        export_seconds = export_decoder(model, model_req_path+'/'+config['MODEL_NAME']+'-decoder.pt2')
+        print(f"Decoder exported in {export_seconds:.1f} s")
+
 """## Loading the model"""
 
 if load_model and os.path.exists(config['LOAD_MODELPATH']):
     checkpoint = torch.load(config['LOAD_MODELPATH'], weights_only=True)
     model.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    # Older checkpoints were all trained in fp32
+    config['PRECISION'] = checkpoint.get('precision', "fp32")
     print("Loaded the model!")
 elif not os.path.exists(config['LOAD_MODELPATH']):
     print("Model directory not found! Please check the path.")
@@ -525,6 +436,27 @@ def prepare_input(text, tokenizer, device, block_size=128):
     # Move input tensors to the appropriate device
     return {key: val.to(device) for key, val in inputs.items()}
 
+"""## Checking the cached decoding path"""
+
+# The cached path must give the same next-token logits as re-running the full block_size window
+with torch.no_grad():
+    model.eval()
+    parity_idx = torch.randint(0, config['VOCAB_SIZE'], (4, config['BLOCK_SIZE'] + 32), device=config['DEVICE'])
+    past_key_values = None
+    for t in range(1, parity_idx.size(1) + 1):
+        full_logits = model(parity_idx[:, :t][:, -config['BLOCK_SIZE']:])[:, -1, :]
+        cached_logits, past_key_values = model(parity_idx[:, t-1:t], past_key_values=past_key_values, use_cache=True)
+        assert torch.allclose(full_logits, cached_logits[:, -1, :], atol=1e-4), f"Logits differ at position {t}"
+print("Cached decoding matches the full recompute.")
+
+# Per-token cost should stay flat with the cache instead of growing with the output length
+bench_ids = custom_tokenizer.encode("In a bustling city filled with secrets, a shadow loomed.", return_tensors="pt").to(config['DEVICE'])
+for use_cache in [False, True]:
+    start_time = time.perf_counter()
+    model.generate(bench_ids, max_new_tokens=config['MAX_OUT_TOKENS'], use_cache=use_cache)
+    elapsed = time.perf_counter() - start_time
+    print(f"use_cache={use_cache}: {1000 * elapsed / config['MAX_OUT_TOKENS']:.2f} ms/token")
+
 # def generate_text(model, tokenizer, input_text, config):
 #     # Prepare the input
 #     inputs = prepare_input(input_text, tokenizer, config["DEVICE"], config["BLOCK_SIZE"])
@@ -533,12 +465,11 @@ def prepare_input(text, tokenizer, device, block_size=128):
 #     output_ids = model.generate(
 #         inputs["input_ids"],
 #         max_new_tokens=config['MAX_OUT_TOKENS'],  # max tokens to generate
-#         pad_token_id=tokenizer.pad_token_id,  # Ensure proper padding
-#         eos_token_id=tokenizer.eos_token_id,  # End generation on EOS
-#         do_sample=True,  # Enable sampling for variety in output
-#         temperature=0.7,  # Adjust temperature for randomness in sampling
-#         top_k=50,  # Limit to top-k tokens to avoid unlikely predictions,
-#         min_length=10
+#         sampling={
+#             "do_sample": True,  # Enable sampling for variety in output
+#             "temperature": 0.7,  # Adjust temperature for randomness in sampling
+#             "top_k": 50  # Limit to top-k tokens to avoid unlikely predictions
+#         }
 #     )
 
 #     # Decode the generated IDs to text
@@ -552,13 +483,38 @@ def generate_text(model, tokenizer, input_text, config):
     # Generate text using the model's `generate` method
     output_ids = model.generate(
         input_ids,
-        max_new_tokens=config['MAX_OUT_TOKENS']  # Max tokens to generate
+        max_new_tokens=config['MAX_OUT_TOKENS'],  # Max tokens to generate
+        sampling=config['SAMPLING'],
+        precision=config['PRECISION']
     )
 
     # Decode the generated IDs to text
     generated_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
     return generated_text
 
+def generate_text_batch(model, tokenizer, input_texts, config):
+    # Generate all the prompts in one batched loop, every prompt stops on its own at <eos> or MAX_OUT_TOKENS
+    output_ids = generate_batch(
+        model, tokenizer, input_texts,
+        max_new_tokens=config['MAX_OUT_TOKENS'],
+        device=config["DEVICE"],
+        sampling=config['SAMPLING'],
+        precision=config['PRECISION']
+    )
+
+    # Decode the generated IDs to text
+    return tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+def generate_text_stream(model, tokenizer, input_text, config):
+    # Yield the generated text piece by piece as soon as every token is sampled
+    yield from stream_text(
+        model, tokenizer, input_text,
+        max_new_tokens=config['MAX_OUT_TOKENS'],
+        device=config["DEVICE"],
+        sampling=config['SAMPLING'],
+        precision=config['PRECISION']
+    )
+
 def evaluate_text_gemini(generated_text):
     # Use the generative model directly for evaluation
     model2 = gemini_ai.GenerativeModel("gemini-1.5-flash")
@@ -712,8 +668,11 @@ score_list = []
 count = 0
 
 if not load_df:
-    for input_text in input_texts_list:
-        output_text = generate_text(model, custom_tokenizer, input_text, config)
+    # The exported decoding step when there is one, the eager model otherwise
+    decoder_path = config['WORKING_DIR']+'/model/'+config['MODEL_NAME']+'-decoder.pt2'
+    batch_model = load_decoder(decoder_path, model) if config['EXPORT_DECODER'] else model
+    output_texts = generate_text_batch(batch_model, custom_tokenizer, input_texts_list, config)
+    for input_text, output_text in zip(input_texts_list, output_texts):
         dynamic_part = f"{input_text} Story begins here:***  {''.join(output_text)}. *** The story ends here"
         final_prompt = f"{step_1_static}{dynamic_part}\n{step_2}\n{step_3}"
         gemini_generated_response = evaluate_text_gemini(final_prompt)
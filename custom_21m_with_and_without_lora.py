@@ -68,13 +68,10 @@ from datasets import Dataset, DatasetDict
 from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, decoders, trainers
 from transformers import PreTrainedTokenizerFast
 import torch.nn.functional as F
+from generation import TokenBuffer, generate_batch, stream_text, generate_speculative, sample_next_token
 
 user_secrets = UserSecretsClient()
 
-wandb_api_key = user_secrets.get_secret("WANDB_API_KEY")
-
-wandb.login(key=wandb_api_key)
-
 gemini_api_key = user_secrets.get_secret("GEMINI_API_KEY")
 
 gemini_ai.configure(api_key=gemini_api_key)
@@ -88,28 +85,66 @@ config = {
     "N_DECODER_BLOCKS": 4,
     "VOCAB_SIZE": 10000,
     "MAX_OUT_TOKENS": 200,
-    "EVAL_ITER": 100,
+    "SAMPLING": {"do_sample": True, "temperature": 1.0, "top_k": None, "top_p": 1.0, "repetition_penalty": 1.0},
+    "PRECISION": "fp32",  # "fp32", "bf16" (CPU or GPU) or "fp16" (GPU only)
+    "TOKEN_SHARDS_DIR": None,  # Directory written by token_shards.py, None tokenizes the dataset on every run
+    "PACK_SEQUENCES": False,  # Join the stories with <eos> into full BLOCK_SIZE windows instead of padding every story
+    "DOCUMENT_MASK": False,  # With PACK_SEQUENCES, also keep attention within every story (CAUSAL_ATTENTION only, train_model raises otherwise)
+    "CAUSAL_ATTENTION": False,  # CausalGPT2 (causal SDPA blocks, KV cache), convert_checkpoint.py converts custom-21M.pt
+    "BUCKET_BY_LENGTH": False,  # Batch stories of similar length and pad only to the longest story of the batch
+    "SPLIT_SEED": 42,  # Fixed train/validation split, so the tokenized splits can be reused between runs
+    "NUM_PROC": os.cpu_count(),  # Tokenization worker processes
+    "CACHE_DIR": "/kaggle/working/tokenized_cache",
+    "STREAMING": False,  # Stream, tokenize and pack the whole train split on the fly instead of a used_dataset_size subset
+    "SHUFFLE_BUFFER": 10000,  # Stories held in the streaming shuffle buffer (per loader worker)
+    "NUM_WORKERS": 2,  # DataLoader worker processes, 0 loads the batches in the training process
+    "PIN_MEMORY": torch.cuda.is_available(),  # Page-locked batches, copied to the GPU asynchronously
+    "PERSISTENT_WORKERS": True,  # Keep the workers alive between epochs and evaluations
+    "PREFETCH_FACTOR": 4,  # Batches prepared in advance by every worker
+    "COMPILE": False,  # torch.compile the model for training, falls back to eager mode where it is not supported
+    "EXPORT_DECODER": False,  # Export next_token_logits (AOTInductor) after training and generate the batches with it
+    "DDP_WORLD_SIZE": 1,  # CPU training processes (DistributedDataParallel over gloo), 1 trains in this process
+    "EVAL_ITER": 100,  # Validation batches per evaluation, None evaluates the whole validation set
+    "EVAL_EVERY_STEPS": None,  # Evaluate (and count PATIENCE) every EVAL_EVERY_STEPS steps, None evaluates after every epoch
+    "METRICS_SINKS": ["wandb"],  # "wandb" and/or "jsonl", only "jsonl" runs offline
+    "METRICS_PATH": "/kaggle/working/metrics.jsonl",  # Written by the "jsonl" sink
+    "LOG_EVERY_STEPS": 50,  # Training metrics are read back from the device and logged every LOG_EVERY_STEPS steps
+    "LOG_EVERY_SECS": 10,  # ... or every LOG_EVERY_SECS seconds, whichever comes first
     "LR": 3e-4,
-    "BATCH_SIZE": 32,
+    "BATCH_SIZE": 32,  # Stories per optimizer step
+    "MICRO_BATCH_SIZE": None,  # Stories per forward/backward pass, gradients are accumulated over the BATCH_SIZE stories
+    "LOSS_CHUNK_SIZE": None,  # Target positions per vocabulary projection chunk, None computes all the logits at once
     "EPOCHS": 5,
     "PATIENCE": 3,
+    "CHECKPOINT_DIR": "/kaggle/working/checkpoints",  # Full training state for RESUME, None disables the checkpoints
+    "CHECKPOINT_EVERY_STEPS": 1000,  # Also checkpointed after every epoch
+    "KEEP_CHECKPOINTS": 3,  # Newest checkpoints kept on disk, at least 1
+    "RESUME": False,  # Continue from the latest checkpoint of CHECKPOINT_DIR
     "MODEL_NAME": "custom-21M",
     "WORKING_DIR": "/kaggle/working",
+    "SPECULATIVE_BENCHMARK": False,  # Speculative vs plain generate on CPU; measured 0.69x (slower), so off by default
+    "DRAFT_MODELPATH": "/kaggle/working/model/custom-8M.pt",
+    "DRAFT_EMB_SIZE": 256,
+    "SPECULATIVE_K": 4,
     "DEVICE": 'cuda' if torch.cuda.is_available() else 'cpu'
 }
 assert config['EMB_SIZE'] % config['N_ATTENTION_HEADS'] == 0
 
-wandb.init(
-    project='custom-21M',
-    config=config
-)
-text_table = wandb.Table(columns=['epoch', 'loss', 'predicted text'])
+if "wandb" in config['METRICS_SINKS']:
+    # The key is only needed (and looked up) when logging to wandb
+    wandb_api_key = user_secrets.get_secret("WANDB_API_KEY")
+    wandb.login(key=wandb_api_key)
+    wandb.init(
+        project='custom-21M',
+        config=config
+    )
+    text_table = wandb.Table(columns=['epoch', 'loss', 'predicted text'])
 
 load_model = False
 
 load_df = False
 
-dataset = load_dataset("roneneldan/TinyStories")
+dataset = load_dataset("roneneldan/TinyStories", streaming=config['STREAMING'])
 
 loaded_vocab_dataset = DatasetDict.load_from_disk('/kaggle/input/vocab-dict-v2/vocab_dict_v2')
 
@@ -124,49 +159,19 @@ if "[UNK]" not in custom_vocab_dict:
 
 used_dataset_size = 100000
 
-sampled_dataset = dataset['train'].train_test_split(train_size=0.8, test_size=0.2)
-train_dataset, val_dataset = sampled_dataset['train'].select(range(int(0.8 * used_dataset_size))), sampled_dataset['test'].select(range(int(0.2 * used_dataset_size)))
-
-class GPT2FromScratch(nn.Module):
-    def __init__(self, config):
-        super(GPT2FromScratch, self).__init__()
-        self.embeddings = nn.Embedding(config["VOCAB_SIZE"], config["EMB_SIZE"])
-        self.blocks = nn.ModuleList([
-            nn.TransformerEncoderLayer(
-                d_model=config["EMB_SIZE"],
-                nhead=config["N_ATTENTION_HEADS"],
-                dim_feedforward=config["EMB_SIZE"] * 4,
-                activation='gelu'
-            )
-            for _ in range(config["N_DECODER_BLOCKS"])
-        ])
-        self.final_norm = nn.LayerNorm(config["EMB_SIZE"])
-        self.head = nn.Linear(config["EMB_SIZE"], config["VOCAB_SIZE"])
-        self.block_size = config.get("BLOCK_SIZE", 128)  # Define block size for context
-
-    def forward(self, x):
-        x = self.embeddings(x)
-        for block in self.blocks:
-            x = block(x)
-        x = self.final_norm(x)
-        return self.head(x)
-
-    def generate(self, idx, max_new_tokens):
-        self.eval()  # Ensure the model is in evaluation mode
-        for _ in range(max_new_tokens):
-            # Crop idx to the last block_size tokens
-            idx_cond = idx[:, -self.block_size:]
-            # Get the predictions
-            logits = self(idx_cond)  # Only use logits (ignore loss)
-            # Focus only on the last time step
-            logits = logits[:, -1, :]  # (B, VOCAB_SIZE)
-            # Apply softmax to get probabilities
-            probs = F.softmax(logits, dim=-1)  # (B, VOCAB_SIZE)
-            # Sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)  # (B, 1)
-            # Append the sampled index to the running sequence
-            idx = torch.cat((idx, idx_next), dim=1)  # (B, T+1)
-        return idx
+if not config['STREAMING']:
+    sampled_dataset = dataset['train'].train_test_split(train_size=0.8, test_size=0.2, seed=config['SPLIT_SEED'])
+    train_dataset, val_dataset = sampled_dataset['train'].select(range(int(0.8 * used_dataset_size))), sampled_dataset['test'].select(range(int(0.2 * used_dataset_size)))
+
+from models import GPT2FromScratch, CausalGPT2
+from quantization import save_quantized_checkpoint
+from training import train_model, check_precision_parity
+from distributed import train_distributed
+from compilation import compile_model, export_decoder, load_decoder
+from token_shards import TokenShardDataset
+from tokenization import tokenize_dataset
+from streaming import StreamingPackedDataset
+from batching import PackedTokenDataset, pack_documents, LengthBucketSampler, PadCollator, sequence_lengths, loader_settings
 
 # # LoRA Layer Integration for Low-Rank Adaptation on the final layer
 
@@ -193,13 +198,14 @@ class GPT2FromScratch(nn.Module):
 #         logits = self.model(x)
 #         return {'logits': logits}  # Return a dictionary with logits
 
-#     def generate(self, input_ids, max_length=50, **kwargs):
-#         output = input_ids
+#     def generate(self, input_ids, max_length=50, sampling=None, **kwargs):
+#         buffer = TokenBuffer(input_ids, max_length)
 #         for _ in range(max_length):
-#             logits = self.forward(output)['logits']
-#             next_token = torch.argmax(logits[:, -1], dim=-1).unsqueeze(-1)
-#             output = torch.cat((output, next_token), dim=1)
-#         return output
+#             logits = self.forward(buffer.tokens)['logits']
+#             # Greedy unless other sampling options are given
+#             next_token = sample_next_token(logits[:, -1], sampling or {"do_sample": False}, buffer.tokens)
+#             buffer.append(next_token)
+#         return buffer.tokens
 
 # Create a tokenizer from scratch with custom vocab
 tokenizer = Tokenizer(models.WordLevel(vocab=custom_vocab_dict, unk_token="[UNK]"))
@@ -228,23 +234,63 @@ custom_tokenizer.save_pretrained("custom_tokenizer")
 custom_tokenizer = AutoTokenizer.from_pretrained("custom_tokenizer")
 print(f"Custom tokenizer vocabulary size: {custom_tokenizer.vocab_size}")
 
-# Tokenization function for HuggingFace dataset
-def tokenize_function(examples):
-    return custom_tokenizer(examples["text"], padding="max_length", truncation=True, max_length=config['BLOCK_SIZE'])
-
-train_dataset = train_dataset.map(tokenize_function, batched=True)
-val_dataset = val_dataset.map(tokenize_function, batched=True)
+# [PAD] targets are left out of the training and validation losses
+config['PAD_TOKEN_ID'] = custom_tokenizer.pad_token_id
+
+if config['STREAMING']:
+    # The stories are shuffled in a bounded buffer, tokenized and packed in the loader workers, memory stays constant
+    train_dataset = StreamingPackedDataset(dataset['train'], custom_tokenizer, config['BLOCK_SIZE'], config['BATCH_SIZE'], shuffle_buffer=config['SHUFFLE_BUFFER'], seed=config['SPLIT_SEED'])
+    val_dataset = StreamingPackedDataset(dataset['validation'], custom_tokenizer, config['BLOCK_SIZE'], config['BATCH_SIZE'], shuffle_buffer=0)
+elif config['TOKEN_SHARDS_DIR'] is not None:
+    # Pre-tokenized memory-mapped stories, nothing to tokenize at startup
+    train_shards = TokenShardDataset(config['TOKEN_SHARDS_DIR'], 'train', custom_tokenizer, config['BLOCK_SIZE'], padding=not config['BUCKET_BY_LENGTH'])
+    val_shards = TokenShardDataset(config['TOKEN_SHARDS_DIR'], 'validation', custom_tokenizer, config['BLOCK_SIZE'], padding=not config['BUCKET_BY_LENGTH'])
+    train_dataset = data.Subset(train_shards, range(min(int(0.8 * used_dataset_size), len(train_shards))))
+    val_dataset = data.Subset(val_shards, range(min(int(0.2 * used_dataset_size), len(val_shards))))
+elif not config['PACK_SEQUENCES']:
+    # Tokenized in NUM_PROC processes and cached on (stories, tokenizer, BLOCK_SIZE), so unchanged re-runs skip it.
+    # With BUCKET_BY_LENGTH every batch is padded by PadCollator instead
+    padding = False if config['BUCKET_BY_LENGTH'] else "max_length"
+    train_dataset = tokenize_dataset(train_dataset, custom_tokenizer, config['BLOCK_SIZE'], config['CACHE_DIR'], padding=padding, num_proc=config['NUM_PROC'])
+    val_dataset = tokenize_dataset(val_dataset, custom_tokenizer, config['BLOCK_SIZE'], config['CACHE_DIR'], padding=padding, num_proc=config['NUM_PROC'])
+
+if config['PACK_SEQUENCES'] and not config['STREAMING']:
+    # Stories joined by <eos> and cut into contiguous BLOCK_SIZE windows, no position is spent on [PAD]
+    eos_token_id = custom_tokenizer.convert_tokens_to_ids('<eos>')
+    if config['TOKEN_SHARDS_DIR'] is not None:
+        train_documents = [train_shards.document(i) for i in train_dataset.indices]
+        val_documents = [val_shards.document(i) for i in val_dataset.indices]
+    else:
+        train_documents = custom_tokenizer(train_dataset["text"])["input_ids"]
+        val_documents = custom_tokenizer(val_dataset["text"])["input_ids"]
+    train_dataset = PackedTokenDataset(pack_documents(train_documents, eos_token_id), config['BLOCK_SIZE'], eos_token_id, document_ids=config['DOCUMENT_MASK'])
+    val_dataset = PackedTokenDataset(pack_documents(val_documents, eos_token_id), config['BLOCK_SIZE'], eos_token_id, document_ids=config['DOCUMENT_MASK'])
 
 # Convert tokenized dataset to PyTorch tensors
-train_dataset.set_format(type='torch', columns=['input_ids'])
-val_dataset.set_format(type='torch', columns=['input_ids'])
-
-train_loader = data.DataLoader(train_dataset, batch_size=config['BATCH_SIZE'], shuffle=True)
-val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], shuffle=False)
+if config['TOKEN_SHARDS_DIR'] is None and not config['PACK_SEQUENCES'] and not config['STREAMING']:
+    train_dataset.set_format(type='torch', columns=['input_ids'])
+    val_dataset.set_format(type='torch', columns=['input_ids'])
+
+if config['STREAMING']:
+    # Shuffled by the dataset itself. New workers every epoch, they need the dataset's current epoch and position
+    train_loader = data.DataLoader(train_dataset, batch_size=config['BATCH_SIZE'], **loader_settings(config, persistent_workers=False))
+    val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], **loader_settings(config))
+elif config['BUCKET_BY_LENGTH'] and not config['PACK_SEQUENCES']:
+    # Batches of stories with similar lengths, padded to their longest story
+    pad_collate = PadCollator(config['PAD_TOKEN_ID'])
+    train_sampler = LengthBucketSampler(sequence_lengths(train_dataset), config['BATCH_SIZE'], shuffle=True)
+    # Unshuffled, so every evaluation scores the same EVAL_ITER batches (whole buckets of stories)
+    val_sampler = LengthBucketSampler(sequence_lengths(val_dataset), config['BATCH_SIZE'], shuffle=False)
+    train_loader = data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=pad_collate, **loader_settings(config))
+    val_loader = data.DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=pad_collate, **loader_settings(config))
+else:
+    train_loader = data.DataLoader(train_dataset, batch_size=config['BATCH_SIZE'], shuffle=True, **loader_settings(config))
+    val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], shuffle=False, **loader_settings(config))
 
 print(len(custom_tokenizer))
 
-model = GPT2FromScratch(config)
+model_class = CausalGPT2 if config['CAUSAL_ATTENTION'] else GPT2FromScratch
+model = model_class(config)
 
 model = model.to(config['DEVICE'])
 
@@ -252,77 +298,22 @@ total_params = sum(p.numel() for p in model.parameters())
 print(f"Total Parameters: {total_params}")
 
 optimizer = torch.optim.Adam(model.parameters(), lr=config['LR'])
-loss_fn = torch.nn.CrossEntropyLoss()
-
-@torch.no_grad()
-def eval_model(training_model: torch.nn.Module, val_loader: data.DataLoader):
-    training_model.eval()
-    losses = torch.zeros(config['EVAL_ITER'])
-    for k in range(config['EVAL_ITER']):
-        batch = next(iter(val_loader))
-        s_val = batch['input_ids'].to(config['DEVICE'])
-        t_val = s_val[:, 1:].clone()
-        s_val = s_val[:, :-1]
-        val_logits = training_model(s_val)
-        val_logits = val_logits.view(s_val.size(0) * s_val.size(1), config['VOCAB_SIZE'])
-        t_val = t_val.view(s_val.size(0) * s_val.size(1))
-        losses[k] = torch.nn.functional.cross_entropy(val_logits, t_val).item()
-    training_model.train()
-    return losses.mean()
-
-def train_model(model, train_loader, val_loader, optimizer, config, loss_fn):
-    best_val_loss = float('inf')
-    patience_counter = 0
-
-    try:
-        for epoch in range(config['EPOCHS']):
-            model.train()
-            epoch_loss = 0
-            epoch_progress = tqdm(train_loader, desc=f"Training Epoch {epoch+1}/{config['EPOCHS']}: ", leave=False)
-
-            for b_idx, batch in enumerate(epoch_progress):
-                sources = batch['input_ids'].to(config['DEVICE'])
-                targets = sources[:, 1:].clone().to(config['DEVICE'])
-                sources = sources[:, :-1]
-                logits = model(sources)  # Direct tensor output
-                batch_size = sources.size(0)
-                seq_length = sources.size(1)
-                logits = logits.view(batch_size * seq_length, config['VOCAB_SIZE'])
-                targets = targets.view(batch_size * seq_length)
-                loss = loss_fn(logits, targets)
-                wandb.log({"loss": loss.item()})
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                epoch_loss += loss.item()
-                avg_loss = epoch_loss / (b_idx + 1)
-                epoch_progress.set_postfix(training_loss=avg_loss)
-
-            avg_epoch_loss = epoch_loss / len(train_loader)
-            print(f"Epoch {epoch+1}/{config['EPOCHS']} completed with average training loss: {avg_epoch_loss}")
-
-            val_loss = eval_model(model, val_loader)
-            print(f"Validation loss after {epoch+1} epochs: {val_loss}")
-            wandb.log({"val_loss": val_loss})
-
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                patience_counter = 0
-                print(f"New best validation loss: {val_loss}.")
-            else:
-                patience_counter += 1
-                print(f"No improvement in validation loss. Patience counter: {patience_counter}")
-
-            if patience_counter >= config['PATIENCE']:
-                print("Early stopping triggered.")
-                break
-
-    except KeyboardInterrupt:
-        print("Training interrupted.")
-    print("Training completed.")
-
-if not load_model:
-    train_model(model, train_loader, val_loader, optimizer, config, loss_fn)
+loss_fn = torch.nn.CrossEntropyLoss(ignore_index=config['PAD_TOKEN_ID'])
+
+if not load_model and config['PRECISION'] != "fp32":
+    check_precision_parity(model, train_loader, optimizer, config, loss_fn, n_steps=20)
+
+if not load_model and config['DDP_WORLD_SIZE'] > 1:
+    # Every rank trains on its own shard of train_dataset with BATCH_SIZE stories per step
+    train_distributed(model, train_dataset, val_dataset, optimizer, config, loss_fn, config['DDP_WORLD_SIZE'], collate_fn=train_loader.collate_fn)
+elif not load_model:
+    training_model = model
+    if config['COMPILE']:
+        # Compiled up front on a batch of the loader, variable length batches are compiled with dynamic shapes
+        example_sources = next(iter(train_loader))['input_ids'][:, :-1].to(config['DEVICE'])
+        training_model, compile_seconds = compile_model(model, example_sources, config['PRECISION'], dynamic=True if config['BUCKET_BY_LENGTH'] else None)
+        print(f"Compiled the model in {compile_seconds:.1f} s")
+    train_model(training_model, train_loader, val_loader, optimizer, config, loss_fn)
 
 model_req_path = config['WORKING_DIR']+'/model'
 
@@ -331,15 +322,30 @@ if not load_model:
         os.mkdir(model_req_path)
 
     torch.save({'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict()
+                'optimizer_state_dict': optimizer.state_dict(),
+                'precision': config['PRECISION']
                 }, model_req_path+'/'+config['MODEL_NAME']+'.pt')
 
     print("Model saved!")
 
+    # Dynamic int8 copy for CPU inference, loaded with load_quantized_model
+    save_quantized_checkpoint(model, model_class.__name__, config, model_req_path+'/'+config['MODEL_NAME']+'-int8.pt')
+
+    print("Int8 model saved!")
+
+    if config['EXPORT_DECODER']:
+        # Decoding step for generate_batch, loaded with load_decoder
+        export_seconds = export_decoder(model, model_req_path+'/'+config['MODEL_NAME']+'-decoder.pt2')
+        print(f"Decoder exported in {export_seconds:.1f} s")
+
 if load_model and os.path.exists(model_req_path):
     checkpoint = torch.load(model_req_path+'/'+config['MODEL_NAME']+'.pt', weights_only=True)
     model.load_state_dict(checkpoint['model_state_dict'])
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if 'optimizer_state_dict' in checkpoint:
+        # Converted checkpoints (convert_checkpoint.py) have no optimizer state
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    # Older checkpoints were all trained in fp32
+    config['PRECISION'] = checkpoint.get('precision', "fp32")
     print("Loaded the model!")
 elif not os.path.exists(model_req_path):
     print("Model directory not found! Please check the path.")
@@ -353,6 +359,35 @@ def prepare_input(text, tokenizer, device, block_size=128):
     # Move input tensors to the appropriate device
     return {key: val.to(device) for key, val in inputs.items()}
 
+# Parity check: the incremental decoding path must give the same next-token logits as the full recompute
+with torch.no_grad():
+    model.eval()
+    parity_idx = torch.randint(0, config['VOCAB_SIZE'], (4, config['BLOCK_SIZE'] + 32), device=config['DEVICE'])
+    if config['CAUSAL_ATTENTION']:
+        # CausalGPT2 attends to the whole prefix, so the newest token goes through its KV cache. The
+        # position embeddings stop at BLOCK_SIZE, which is where _decode re-encodes the window.
+        past_key_values = None
+        for t in range(1, config['BLOCK_SIZE'] + 1):
+            full_logits = model(parity_idx[:, :t])[:, -1, :]
+            cached_logits, past_key_values = model(parity_idx[:, t-1:t], past_key_values=past_key_values, use_cache=True)
+            assert torch.allclose(full_logits, cached_logits[:, -1, :], atol=1e-4), f"Logits differ at position {t}"
+    else:
+        for t in range(1, parity_idx.size(1) + 1):
+            full_logits = model(parity_idx[:, :t][:, -config['BLOCK_SIZE']:])[:, -1, :]
+            cached_logits = model(parity_idx[:, t-1:t])[:, -1, :]
+            assert torch.allclose(full_logits, cached_logits, atol=1e-4), f"Logits differ at position {t}"
+print("Incremental decoding matches the full recompute.")
+
+# CPU benchmark: tokens/sec of a full MAX_OUT_TOKENS story with and without the incremental path
+model = model.to('cpu')
+bench_ids = custom_tokenizer.encode("In a bustling city filled with secrets, a shadow loomed.", return_tensors="pt")
+for use_cache in [False, True]:
+    start_time = time.perf_counter()
+    model.generate(bench_ids, max_new_tokens=config['MAX_OUT_TOKENS'], use_cache=use_cache)
+    elapsed = time.perf_counter() - start_time
+    print(f"use_cache={use_cache}: {config['MAX_OUT_TOKENS'] / elapsed:.1f} tokens/sec on CPU")
+model = model.to(config['DEVICE'])
+
 def generate_text(model, tokenizer, input_text, config):
     # Tokenize the input text
     input_ids = tokenizer.encode(input_text, return_tensors="pt").to(config["DEVICE"])
@@ -360,13 +395,38 @@ def generate_text(model, tokenizer, input_text, config):
     # Generate text using the model's `generate` method
     output_ids = model.generate(
         input_ids,
-        max_new_tokens=config['MAX_OUT_TOKENS']  # Max tokens to generate
+        max_new_tokens=config['MAX_OUT_TOKENS'],  # Max tokens to generate
+        sampling=config['SAMPLING'],
+        precision=config['PRECISION']
     )
 
     # Decode the generated IDs to text
     generated_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
     return generated_text
 
+def generate_text_batch(model, tokenizer, input_texts, config):
+    # Generate all the prompts in one batched loop, every prompt stops on its own at <eos> or MAX_OUT_TOKENS
+    output_ids = generate_batch(
+        model, tokenizer, input_texts,
+        max_new_tokens=config['MAX_OUT_TOKENS'],
+        device=config["DEVICE"],
+        sampling=config['SAMPLING'],
+        precision=config['PRECISION']
+    )
+
+    # Decode the generated IDs to text
+    return tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+def generate_text_stream(model, tokenizer, input_text, config):
+    # Yield the generated text piece by piece as soon as every token is sampled
+    yield from stream_text(
+        model, tokenizer, input_text,
+        max_new_tokens=config['MAX_OUT_TOKENS'],
+        device=config["DEVICE"],
+        sampling=config['SAMPLING'],
+        precision=config['PRECISION']
+    )
+
 def evaluate_text_gemini(generated_text):
     # Use the generative model directly for evaluation
     model2 = gemini_ai.GenerativeModel("gemini-1.5-flash")
@@ -485,6 +545,40 @@ input_texts_list = [
     "In a world where memories could be traded, one boy remembered."
 ]
 
+# Speculative decoding needs next_token_logits, which CausalGPT2 does not have
+if config['SPECULATIVE_BENCHMARK'] and config['CAUSAL_ATTENTION']:
+    print("Speculative decoding needs GPT2FromScratch, skipping the benchmark.")
+elif config['SPECULATIVE_BENCHMARK'] and not os.path.exists(config['DRAFT_MODELPATH']):
+    # A randomly initialised draft would only measure rejected drafts
+    print("Draft model not found! Please check the path. Skipping the benchmark.")
+elif config['SPECULATIVE_BENCHMARK']:
+    # Speculative decoding: the custom-8M model drafts SPECULATIVE_K tokens that the 21M model checks in one pass
+    draft_config = {**config, "EMB_SIZE": config['DRAFT_EMB_SIZE'], "MODEL_NAME": "custom-8M"}
+    draft_model = GPT2FromScratch(draft_config)
+    draft_checkpoint = torch.load(config['DRAFT_MODELPATH'], weights_only=True)
+    draft_model.load_state_dict(draft_checkpoint['model_state_dict'])
+    print("Loaded the draft model!")
+
+    # CPU benchmark over all the prompts: accepted tokens per 21M call and wall-clock speedup over plain generate
+    model, draft_model = model.to('cpu'), draft_model.to('cpu')
+    plain_time, speculative_time = 0.0, 0.0
+    speculative_stats = Counter()
+    for input_text in input_texts_list:
+        input_ids = custom_tokenizer.encode(input_text, return_tensors="pt")
+
+        start_time = time.perf_counter()
+        model.generate(input_ids, max_new_tokens=config['MAX_OUT_TOKENS'], sampling=config['SAMPLING'])
+        plain_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        _, stats = generate_speculative(model, draft_model, input_ids, config['MAX_OUT_TOKENS'], num_draft_tokens=config['SPECULATIVE_K'], sampling=config['SAMPLING'])
+        speculative_time += time.perf_counter() - start_time
+        speculative_stats.update(stats)
+
+    print(f"Tokens per 21M model call: {speculative_stats['generated_tokens'] / speculative_stats['target_calls']:.2f}")
+    print(f"Plain: {plain_time:.1f}s, speculative: {speculative_time:.1f}s, speedup: {plain_time / speculative_time:.2f}x")
+model = model.to(config['DEVICE'])
+
 pattern = r"Grammar: (\d+)/10; Consistency: (\d+)/10; Creativity: (\d+)/10; Plot: (\d+)/10; Age group: ([A-Z])"
 score_list = []
 count = 0
@@ -514,8 +608,11 @@ step_3 = (
 )
 
 if not load_df:
-    for input_text in input_texts_list:
-        output_text = generate_text(model, custom_tokenizer, input_text, config)
+    # The exported decoding step when there is one, the eager model otherwise
+    decoder_path = config['WORKING_DIR']+'/model/'+config['MODEL_NAME']+'-decoder.pt2'
+    batch_model = load_decoder(decoder_path, model) if config['EXPORT_DECODER'] else model
+    output_texts = generate_text_batch(batch_model, custom_tokenizer, input_texts_list, config)
+    for input_text, output_text in zip(input_texts_list, output_texts):
         # print(output_text)
         dynamic_part = f"{input_text} Story begins here:*  {''.join(output_text)}. * The story ends here"
         final_prompt = f"{step_1_static}{dynamic_part}\n{step_2}\n{step_3}"
@@ -607,11 +704,13 @@ for name, param in model.named_parameters():
 total_params = sum(p.numel() for p in model.parameters())
 print(f"Total Parameters: {total_params}")
 
-train_model(model, train_loader, val_loader, optimizer, config, loss_fn)
+# Separate checkpoints, a LoRA run must not resume from the base model's training state
+lora_train_config = dict(config, CHECKPOINT_DIR=config['CHECKPOINT_DIR'] and config['CHECKPOINT_DIR'] + '_lora')
+train_model(model, train_loader, val_loader, optimizer, lora_train_config, loss_fn)
 
 if not load_df:
-    for input_text in input_texts_list:
-        output_text = generate_text(model, custom_tokenizer, input_text, config)
+    output_texts = generate_text_batch(model, custom_tokenizer, input_texts_list, config)
+    for input_text, output_text in zip(input_texts_list, output_texts):
         print(output_text)
         dynamic_part = f"{input_text} Story begins here:*  {''.join(output_text)}. * The story ends here"
         final_prompt = f"{step_1_static}{dynamic_part}\n{step_2}\n{step_3}"
@@ -643,7 +742,8 @@ df1.tail()
 model_req_path = config['WORKING_DIR']+'/model'
 
 torch.save({'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict()
+                'optimizer_state_dict': optimizer.state_dict(),
+                'precision': config['PRECISION']
                 }, model_req_path+'/'+config['MODEL_NAME']+'LoRA'+'.pt')
 
 df1.head(20)
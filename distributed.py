@@ -0,0 +1,90 @@
+import os
+import socket
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils import data
+from batching import loader_settings
+from training import train_model, supports_document_ids
+
+
+def free_port():
+    # A port nothing listens on right now, picked by the OS
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def init_process(rank, world_size, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # The cores are split between the ranks instead of every rank running one thread per core
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+
+def _run(rank, fn, world_size, port, args):
+    init_process(rank, world_size, port)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size, args=(), port=None, start_method='spawn'):
+    """
+    Runs fn(rank, world_size, *args) in world_size CPU processes joined in a gloo process group and waits
+    for all of them. With start_method='fork' fn and args are inherited instead of pickled, which also
+    works for functions and objects defined in a notebook. Without port every launch picks a free one,
+    so back-to-back launches never wait for the previous group's port.
+    """
+    if port is None:
+        port = free_port()
+    mp.start_processes(_run, args=(fn, world_size, port, args), nprocs=world_size, start_method=start_method)
+
+
+def distributed_loader(dataset, config, shuffle=True, collate_fn=None):
+    # This rank's shard of dataset, reshuffled every epoch by train_model through sampler.set_epoch
+    sampler = data.DistributedSampler(dataset, shuffle=shuffle, seed=config['SPLIT_SEED'])
+    return data.DataLoader(dataset, batch_size=config['BATCH_SIZE'], sampler=sampler, collate_fn=collate_fn, **loader_settings(config))
+
+
+def _train_rank(rank, world_size, model, train_dataset, val_dataset, optimizer, config, loss_fn, collate_fn, result_dir):
+    # The forked ranks start with the same RNG state, give every rank its own dropout masks
+    torch.manual_seed(torch.initial_seed() + rank)
+    ddp_model = DistributedDataParallel(model)
+    # Fresh optimizer of the same kind over this replica's parameters
+    rank_optimizer = optimizer.__class__(ddp_model.parameters(), **optimizer.defaults)
+    train_loader = distributed_loader(train_dataset, config, shuffle=True, collate_fn=collate_fn)
+    val_loader = data.DataLoader(val_dataset, batch_size=config['BATCH_SIZE'], shuffle=False, collate_fn=collate_fn, **loader_settings(config))
+    train_model(ddp_model, train_loader, val_loader, rank_optimizer, config, loss_fn)
+    if rank == 0:
+        torch.save(model.state_dict(), os.path.join(result_dir, "model.pt"))
+
+
+def train_distributed(model, train_dataset, val_dataset, optimizer, config, loss_fn, world_size, collate_fn=None):
+    """
+    train_model with DistributedDataParallel over world_size CPU processes (gloo backend).
+
+    Every rank trains on its DistributedSampler shard of train_dataset, BATCH_SIZE stories per step, so an
+    optimizer step covers world_size * BATCH_SIZE stories; the gradients are all-reduced during backward.
+    Every rank evaluates the whole val_dataset, so all of them take the same early stopping decisions. Only
+    rank 0 logs and writes checkpoints. model is updated with the trained weights of rank 0 at the end.
+    """
+    if config['DEVICE'] != 'cpu':
+        raise ValueError(f"Distributed training runs on CPU processes, got DEVICE {config['DEVICE']!r}")
+    if isinstance(train_dataset, data.IterableDataset):
+        raise ValueError("Streaming datasets are split between loader workers, not between ranks")
+    if config.get('LOSS_CHUNK_SIZE'):
+        # hidden_states would bypass the DDP forward, which the gradient all-reduce depends on
+        raise ValueError("LOSS_CHUNK_SIZE is not supported with distributed training")
+    if getattr(train_dataset, 'document_ids', False) and not supports_document_ids(model):
+        # Checked again by train_model, but before the ranks are started
+        raise ValueError(f"DOCUMENT_MASK needs a model that takes document_ids (CausalGPT2), got {type(model).__name__}")
+
+    result_dir = tempfile.mkdtemp()
+    launch(_train_rank, world_size, args=(model, train_dataset, val_dataset, optimizer, config, loss_fn, collate_fn, result_dir), start_method='fork')
+    model.load_state_dict(torch.load(os.path.join(result_dir, "model.pt"), weights_only=True))
+    return model
@@ -0,0 +1,391 @@
+import torch
+from torch.nn import functional as F
+from precision import autocast_context
+
+
+class TokenBuffer:
+    """
+    Preallocated (B, prompt_len + max_new_tokens) token buffer for autoregressive decoding.
+    New tokens are written in place instead of re-allocating the whole sequence with torch.cat
+    on every step, and the model input window is handed out as a view.
+    """
+    def __init__(self, idx, max_new_tokens):
+        self.buffer = torch.empty((idx.size(0), idx.size(1) + max_new_tokens), dtype=idx.dtype, device=idx.device)
+        self.buffer[:, :idx.size(1)] = idx
+        self.length = idx.size(1)
+
+    def append(self, idx_next):
+        # idx_next: (B, n) tokens to write after the current sequence
+        n = idx_next.size(1)
+        self.buffer[:, self.length:self.length + n] = idx_next
+        self.length += n
+
+    def window(self, size):
+        # View of the last size tokens, like idx[:, -size:]
+        return self.buffer[:, max(self.length - size, 0):self.length]
+
+    def truncate(self, length):
+        # Drop everything after the first length tokens (e.g. rejected speculative tokens)
+        self.length = length
+
+    @property
+    def tokens(self):
+        # View of the whole sequence generated so far, like idx
+        return self.buffer[:, :self.length]
+
+
+# Default sampling options, the same full-vocabulary multinomial sampling the models always used
+DEFAULT_SAMPLING = {
+    "do_sample": True,
+    "temperature": 1.0,
+    "top_k": None,
+    "top_p": 1.0,
+    "repetition_penalty": 1.0,
+}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_sampling(sampling):
+    """
+    The sampling options of sample_next_token with the defaults filled in. Raises ValueError for unknown
+    options and for values that cannot be sampled with: temperature and repetition_penalty must be
+    positive, top_k a positive integer (or None) and top_p in (0, 1].
+    """
+    unknown_options = set(sampling or {}) - set(DEFAULT_SAMPLING)
+    if unknown_options:
+        raise ValueError(f"Unknown sampling options: {sorted(unknown_options)}")
+    sampling = {**DEFAULT_SAMPLING, **(sampling or {})}
+    if not isinstance(sampling['do_sample'], bool):
+        raise ValueError(f"do_sample must be a bool, got {sampling['do_sample']!r}")
+    if not _is_number(sampling['temperature']) or sampling['temperature'] <= 0:
+        raise ValueError(f"temperature must be a positive number, got {sampling['temperature']!r}")
+    if sampling['top_k'] is not None and (not isinstance(sampling['top_k'], int) or isinstance(sampling['top_k'], bool) or sampling['top_k'] <= 0):
+        raise ValueError(f"top_k must be a positive integer or None, got {sampling['top_k']!r}")
+    if not _is_number(sampling['top_p']) or not 0 < sampling['top_p'] <= 1:
+        raise ValueError(f"top_p must be in (0, 1], got {sampling['top_p']!r}")
+    if not _is_number(sampling['repetition_penalty']) or sampling['repetition_penalty'] <= 0:
+        raise ValueError(f"repetition_penalty must be a positive number, got {sampling['repetition_penalty']!r}")
+    return sampling
+
+
+def _apply_repetition_penalty(logits, sampling, prev_tokens):
+    # Push down the logits of every token that already appeared in the row
+    if sampling['repetition_penalty'] == 1.0 or prev_tokens is None:
+        return logits
+    scores = torch.gather(logits, 1, prev_tokens)
+    scores = torch.where(scores < 0, scores * sampling['repetition_penalty'], scores / sampling['repetition_penalty'])
+    return logits.scatter(1, prev_tokens, scores)
+
+
+def _filter_logits(logits, sampling):
+    # Returns the tempered logits of the remaining candidates and their vocabulary indices
+    # (None when every vocabulary entry is still a candidate)
+    if sampling['temperature'] != 1.0:
+        logits = logits / sampling['temperature']
+
+    # Top-k: only the k best candidates are kept (sorted) and softmaxed
+    candidates = None
+    if sampling['top_k'] is not None and sampling['top_k'] < logits.size(-1):
+        logits, candidates = torch.topk(logits, sampling['top_k'], dim=-1)
+
+    # Top-p: keep the smallest set of candidates whose probability mass reaches top_p
+    if sampling['top_p'] < 1.0:
+        if candidates is None:
+            logits, candidates = torch.sort(logits, dim=-1, descending=True)
+        sorted_probs = F.softmax(logits, dim=-1)
+        # A candidate is dropped when the mass before it already reaches top_p, so the best one is always kept
+        outside_nucleus = (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) >= sampling['top_p']
+        logits = logits.masked_fill(outside_nucleus, float('-inf'))
+
+    return logits, candidates
+
+
+def sample_next_token(logits, sampling=None, prev_tokens=None):
+    """
+    Picks the next token of every row from the last-position logits (B, VOCAB_SIZE).
+    sampling is a dict with any of the DEFAULT_SAMPLING keys: repetition_penalty is applied to the
+    tokens in prev_tokens (B, T), then either greedy argmax (do_sample=False) or sampling with
+    temperature, top_k and top_p (nucleus). Works on the whole batch at once, returns (B, 1).
+    """
+    sampling = validate_sampling(sampling)
+    logits = _apply_repetition_penalty(logits, sampling, prev_tokens)
+
+    # Greedy decoding
+    if not sampling['do_sample']:
+        return torch.argmax(logits, dim=-1, keepdim=True)
+
+    logits, candidates = _filter_logits(logits, sampling)
+    probs = F.softmax(logits, dim=-1)
+    idx_next = torch.multinomial(probs, num_samples=1)  # (B, 1)
+    if candidates is not None:
+        # Map the sampled candidate back to its vocabulary index
+        idx_next = torch.gather(candidates, 1, idx_next)
+    return idx_next
+
+
+def sampling_probs(logits, sampling=None, prev_tokens=None):
+    """
+    Full-vocabulary (B, VOCAB_SIZE) distribution that sample_next_token draws from with the same options.
+    Greedy decoding gives a one-hot distribution on the argmax.
+    """
+    sampling = validate_sampling(sampling)
+    logits = _apply_repetition_penalty(logits, sampling, prev_tokens)
+
+    if not sampling['do_sample']:
+        return F.one_hot(torch.argmax(logits, dim=-1), logits.size(-1)).to(logits.dtype)
+
+    vocab_size = logits.size(-1)
+    logits, candidates = _filter_logits(logits, sampling)
+    probs = F.softmax(logits, dim=-1)
+    if candidates is not None:
+        probs = torch.zeros(probs.size(0), vocab_size, dtype=probs.dtype, device=probs.device).scatter(1, candidates, probs)
+    return probs
+
+
+def encode_prompts(tokenizer, input_texts, device):
+    """
+    Tokenizes a list of prompts into one left-padded batch with the tokenizer's [PAD] token.
+    Returns the input ids and the attention mask (1 for real tokens, 0 for padding).
+    """
+    # Left padding keeps the newest token of every row in the last column
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = 'left'
+    try:
+        inputs = tokenizer(input_texts, return_tensors="pt", padding=True)
+    finally:
+        tokenizer.padding_side = padding_side
+    return inputs['input_ids'].to(device), inputs['attention_mask'].to(device)
+
+
+def _cached_logits(model, buffer, padding_mask, active, past_key_values):
+    """
+    (logits, past_key_values) of the active rows for models that attend over the whole sequence (CausalGPT2)
+    and keep a KV cache: the first call encodes the left-padded prompts, later calls only feed the newest
+    tokens. Once the cache holds block_size positions, the last block_size // 2 columns are encoded again.
+    padding_mask is the TokenBuffer of the attention mask, aligned with buffer.
+    """
+    if past_key_values is None or past_key_values[0][0].size(2) >= model.block_size:
+        width = model.block_size if past_key_values is None else model.block_size // 2
+        return model(buffer.window(width)[active], padding_mask=padding_mask.window(width)[active], use_cache=True)
+    cached = past_key_values[0][0].size(2)
+    return model(buffer.window(1)[active], past_key_values=past_key_values, padding_mask=padding_mask.window(cached + 1)[active], use_cache=True)
+
+
+@torch.no_grad()
+def generate_batch(model, tokenizer, input_texts, max_new_tokens, device, batch_size=None, sampling=None, precision="fp32"):
+    """
+    Generates a completion for every prompt in input_texts with one batched decoding loop.
+    Every row stops on its own at <eos> or after max_new_tokens, and finished rows are dropped
+    from the active batch. Returns the prompt followed by the generated token ids for every prompt,
+    as a list of lists without padding.
+
+    Models with next_token_logits are fed the newest token of every row; the others (CausalGPT2) are
+    fed the padded prompts once and then the newest tokens through their KV cache.
+    """
+    if batch_size is not None and len(input_texts) > batch_size:
+        outputs = []
+        for start in range(0, len(input_texts), batch_size):
+            outputs += generate_batch(model, tokenizer, input_texts[start:start+batch_size], max_new_tokens, device, sampling=sampling, precision=precision)
+        return outputs
+
+    model.eval()  # Ensure the model is in evaluation mode
+    eos_token_id = tokenizer.convert_tokens_to_ids('<eos>')
+    input_ids, attention_mask = encode_prompts(tokenizer, input_texts, device)
+
+    # Number of real tokens in every row. With next_token_logits the pads are never fed to the model:
+    # it only needs the newest token of each row (and its position) to predict the next one
+    prompt_lengths = attention_mask.sum(dim=1)
+    lengths = prompt_lengths.clone()
+    stateless = hasattr(model, 'next_token_logits')
+    if not stateless:
+        # Which columns of the buffer hold real tokens, and the cache of the active rows
+        padding_mask = TokenBuffer(attention_mask.bool(), max_new_tokens)
+        past_key_values = None
+
+    # Left-padded prompts followed by the generated tokens, rows that stop early get [PAD] afterwards
+    buffer = TokenBuffer(input_ids, max_new_tokens)
+    idx_next = torch.full((len(input_texts), 1), tokenizer.pad_token_id, dtype=torch.long, device=device)
+    n_generated = torch.zeros(len(input_texts), dtype=torch.long, device=device)
+
+    # Indices of the rows that are still generating
+    active = torch.arange(len(input_texts), device=device)
+    for _ in range(max_new_tokens):
+        with autocast_context(precision, device):
+            if stateless:
+                logits = model.next_token_logits(buffer.window(1)[active, 0], lengths[active] - 1)
+            else:
+                logits, past_key_values = _cached_logits(model, buffer, padding_mask, active, past_key_values)
+                logits = logits[:, -1, :]
+        logits = logits.float()  # (B_active, VOCAB_SIZE)
+        idx_active = sample_next_token(logits, sampling, buffer.tokens[active])  # (B_active, 1)
+
+        idx_next.fill_(tokenizer.pad_token_id)
+        idx_next[active] = idx_active
+        buffer.append(idx_next)
+        if not stateless:
+            real_token = torch.zeros_like(idx_next, dtype=torch.bool)
+            real_token[active] = True
+            padding_mask.append(real_token)
+        n_generated[active] += 1
+        lengths[active] += 1
+
+        # Drop the rows that just produced <eos> from the active batch (and from the cache)
+        keep = idx_active[:, 0] != eos_token_id
+        active = active[keep]
+        if not stateless:
+            past_key_values = [(k[keep], v[keep]) for k, v in past_key_values]
+        if active.numel() == 0:
+            break
+
+    prompt_width = input_ids.size(1)
+    return [
+        row[prompt_width - p_len:prompt_width + n].tolist()
+        for row, p_len, n in zip(buffer.tokens, prompt_lengths.tolist(), n_generated.tolist())
+    ]
+
+
+@torch.no_grad()
+def generate_speculative(model, draft_model, idx, max_new_tokens, num_draft_tokens=4, sampling=None):
+    """
+    Speculative decoding of a single sequence idx (1, T): draft_model proposes num_draft_tokens tokens
+    one by one, model scores all of them in one forward pass, and standard accept/reject sampling keeps
+    the output distribution exactly the one of sampling from model alone. Both models must share the
+    tokenizer and implement next_token_logits.
+    Returns the sequence (1, T + max_new_tokens) and a dict with the number of model / draft_model calls.
+    """
+    model.eval()
+    draft_model.eval()
+    # Room for the speculative tokens written past the final length before they are checked
+    buffer = TokenBuffer(idx, max_new_tokens + num_draft_tokens)
+    max_length = idx.size(1) + max_new_tokens
+    stats = {"target_calls": 0, "draft_calls": 0, "generated_tokens": 0}
+
+    while buffer.length < max_length:
+        length = buffer.length
+        n_draft = min(num_draft_tokens, max_length - length - 1)
+
+        # Draft n_draft tokens with the small model, keeping its distribution of every drafted token
+        draft_probs = []
+        for j in range(n_draft):
+            position = torch.tensor([buffer.length - 1], device=idx.device)
+            logits = draft_model.next_token_logits(buffer.window(1)[:, 0], position)
+            probs = sampling_probs(logits, sampling, buffer.tokens)
+            draft_probs.append(probs[0])
+            buffer.append(torch.multinomial(probs, num_samples=1))
+            stats["draft_calls"] += 1
+        drafted = buffer.tokens[0, length:]  # (n_draft,)
+
+        # Score the last accepted token and every drafted token with the large model in one pass:
+        # row j gives the distribution of the token after the first length + j tokens
+        candidates = buffer.tokens[0, length - 1:]  # (n_draft + 1,)
+        positions = torch.arange(length - 1, length + n_draft, device=idx.device)
+        logits = model.next_token_logits(candidates, positions)  # (n_draft + 1, VOCAB_SIZE)
+        stats["target_calls"] += 1
+
+        # Previous tokens of row j for the repetition penalty: the first length + j tokens, the rest of the
+        # row repeats a token that is already in it so it does not change the penalized set
+        prev_tokens = buffer.tokens.expand(n_draft + 1, -1).clone()
+        beyond_row = torch.arange(length + n_draft, device=idx.device) >= length + torch.arange(n_draft + 1, device=idx.device).unsqueeze(1)
+        prev_tokens[beyond_row] = buffer.tokens[0, 0]
+        target_probs = sampling_probs(logits, sampling, prev_tokens)
+
+        # Accept drafted token j with probability min(1, p(token) / q(token)), stop at the first rejection
+        n_accepted = 0
+        if n_draft > 0:
+            draft_probs = torch.stack(draft_probs)  # (n_draft, VOCAB_SIZE)
+            p = target_probs[:-1].gather(1, drafted.unsqueeze(1))[:, 0]
+            q = draft_probs.gather(1, drafted.unsqueeze(1))[:, 0]
+            accepted = torch.rand(n_draft, device=idx.device) < p / q
+            n_accepted = int(accepted.long().cumprod(dim=0).sum())
+
+        if n_accepted < n_draft:
+            # Rejected: resample from the normalized residual max(0, p - q)
+            residual = (target_probs[n_accepted] - draft_probs[n_accepted]).clamp(min=0)
+            if residual.sum() <= 0:
+                residual = target_probs[n_accepted]
+            next_probs = residual / residual.sum()
+        else:
+            # Every drafted token was accepted: the large model's last row gives one more token for free
+            next_probs = target_probs[n_draft]
+
+        buffer.truncate(length + n_accepted)
+        buffer.append(torch.multinomial(next_probs, num_samples=1).unsqueeze(0))
+        stats["generated_tokens"] += n_accepted + 1
+
+    return buffer.tokens, stats
+
+
+class IncrementalDecoder:
+    """
+    Turns a stream of token ids into text pieces without re-decoding the whole sequence on every token.
+    Only a window of the last few tokens is decoded. The cleanup rules of the decoder (" ." -> ".",
+    " do not" -> " don't", " ' " -> "'") can still change the last two words of the window when more tokens
+    arrive, so the text after its second-to-last space is held back until it is final. flush() returns
+    what is still held back once the stream ends; all the pieces joined equal decoding all the ids at once.
+    """
+    def __init__(self, tokenizer, prompt_ids=(), context_tokens=8):
+        self.tokenizer = tokenizer
+        self.context_tokens = context_tokens
+        self.token_ids = list(prompt_ids)
+        # Only token_ids[prefix_offset:] are decoded, text[:printed] was already emitted (or is prompt)
+        self.prefix_offset = max(len(self.token_ids) - context_tokens, 0)
+        self.text = self._decode(self.prefix_offset)
+        self.printed = len(self.text)
+
+    def _decode(self, offset):
+        return self.tokenizer.decode(self.token_ids[offset:], skip_special_tokens=True)
+
+    def _emit(self, end):
+        if end <= self.printed:
+            return ""
+        piece = self.text[self.printed:end]
+        self.printed = end
+        return piece
+
+    def _slide_window(self):
+        # Moves the window start up to context_tokens tokens before the end, once the text still pending
+        # decodes the same way in the shorter window and a few words of context come before it
+        if len(self.token_ids) - self.prefix_offset <= 2 * self.context_tokens:
+            return
+        offset = len(self.token_ids) - self.context_tokens
+        text = self._decode(offset)
+        pending = self.text[self.printed:]
+        printed = len(text) - len(pending)
+        if printed < 0 or not text.endswith(pending) or text.count(" ", 0, printed) < 3:
+            return
+        self.prefix_offset, self.text, self.printed = offset, text, printed
+
+    def push(self, token_id):
+        # Returns the text made final by token_id (often empty, the last two words are held back)
+        self.token_ids.append(token_id)
+        self.text = self._decode(self.prefix_offset)
+        if self.text.endswith("\ufffd"):
+            # Not a full character yet
+            return ""
+        last_space = self.text.rfind(" ")
+        piece = self._emit(self.text.rfind(" ", 0, last_space) if last_space > 0 else -1)
+        self._slide_window()
+        return piece
+
+    def flush(self):
+        # The held back text, once no more tokens will be pushed
+        return self._emit(len(self.text))
+
+
+def stream_text(model, tokenizer, input_text, max_new_tokens, device, sampling=None, precision="fp32"):
+    """
+    Generator over the completion of input_text: yields every new piece of text as soon as the decoder
+    cleanup can no longer change it (see IncrementalDecoder), i.e. a couple of words behind the sampling.
+    """
+    input_ids = tokenizer.encode(input_text, return_tensors="pt").to(device)
+    decoder = IncrementalDecoder(tokenizer, input_ids[0].tolist())
+    for idx_next in model.generate_stream(input_ids, max_new_tokens, sampling=sampling, precision=precision):
+        text = decoder.push(idx_next[0, 0].item())
+        if text:
+            yield text
+    text = decoder.flush()
+    if text:
+        yield text
@@ -0,0 +1,253 @@
+"""
+Standalone story-completion server.
+
+Loads a checkpoint saved by the training scripts and the saved custom_tokenizer directory once, then
+serves completions over local HTTP. Concurrent requests are batched dynamically: the batcher waits up to
+--max-wait-ms after the first queued request (or until --max-batch-size requests are queued) and runs
+them through one generate_batch call.
+
+    python inference_server.py --model GPT2FromScratch --checkpoint /kaggle/working/model/custom-21M.pt --tokenizer custom_tokenizer
+    python inference_server.py --checkpoint /kaggle/working/model/custom-21M-int8.pt --tokenizer custom_tokenizer
+    curl -X POST localhost:8000/generate -d '{"prompt": "Once upon a time", "max_new_tokens": 50}'
+    curl localhost:8000/stats
+"""
+
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from transformers import AutoTokenizer
+
+from models import MODEL_CLASSES, load_checkpoint_model
+from quantization import quantize_model, load_quantized_model
+from generation import validate_sampling, generate_batch
+
+
+class GenerationRequest:
+    def __init__(self, prompt, max_new_tokens, sampling):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.batch_size = None
+        self.queue_depth = None
+        self.text = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def batch_key(self):
+        # Only requests with the same length and sampling options can share a generate_batch call
+        return self.max_new_tokens, json.dumps(self.sampling, sort_keys=True)
+
+
+class DynamicBatcher:
+    """
+    Collects queued requests into batches of up to max_batch_size, waiting at most max_wait_ms after the
+    first one, and runs them on a single background thread so the model is only used by one batch at a time.
+    """
+    def __init__(self, model, tokenizer, device, max_batch_size=32, max_wait_ms=20, latency_window=1000):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.requests_served = 0
+        self.batches_run = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, request):
+        # Blocks the calling (HTTP handler) thread until the request has been generated
+        self.queue.put(request)
+        request.done.wait()
+        return request
+
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            queue_depth = self.queue.qsize()
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.batch_key, []).append(request)
+
+            for requests in groups.values():
+                started_at = time.perf_counter()
+                try:
+                    output_ids = generate_batch(
+                        self.model, self.tokenizer, [request.prompt for request in requests],
+                        max_new_tokens=requests[0].max_new_tokens,
+                        device=self.device,
+                        sampling=requests[0].sampling
+                    )
+                    texts = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+                except Exception as e:
+                    texts = [None] * len(requests)
+                    for request in requests:
+                        request.error = str(e)
+                finished_at = time.perf_counter()
+
+                for request, text in zip(requests, texts):
+                    request.text = text
+                    request.started_at = started_at
+                    request.finished_at = finished_at
+                    request.batch_size = len(requests)
+                    request.queue_depth = queue_depth
+                    request.done.set()
+
+                with self.stats_lock:
+                    self.latencies.extend(finished_at - request.enqueued_at for request in requests)
+                    self.requests_served += len(requests)
+                    self.batches_run += 1
+                print(f"Batch of {len(requests)} in {1000 * (finished_at - started_at):.0f} ms, queue depth: {queue_depth}")
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            requests_served, batches_run = self.requests_served, self.batches_run
+
+        def percentile(p):
+            return 1000 * latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests_served": requests_served,
+            "batches_run": batches_run,
+            "mean_batch_size": requests_served / batches_run if batches_run else None,
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p95": percentile(0.95),
+        }
+
+
+class GenerationServer(ThreadingHTTPServer):
+    # Let many concurrent clients connect while they wait to be batched
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def make_handler(batcher, default_max_new_tokens):
+    class GenerationHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, batcher.stats())
+            else:
+                self._send_json(404, {"error": "Unknown path, use POST /generate or GET /stats"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send_json(404, {"error": "Unknown path, use POST /generate or GET /stats"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt = body["prompt"]
+                max_new_tokens = body.get("max_new_tokens", default_max_new_tokens)
+                sampling = body.get("sampling") or {}
+                if not isinstance(prompt, str) or not prompt:
+                    raise ValueError("prompt must be a non-empty string")
+                if not isinstance(max_new_tokens, int) or isinstance(max_new_tokens, bool):
+                    raise ValueError("max_new_tokens must be an integer")
+                if not 0 < max_new_tokens <= default_max_new_tokens:
+                    raise ValueError(f"max_new_tokens must be between 1 and {default_max_new_tokens}")
+                if not isinstance(sampling, dict):
+                    raise ValueError("sampling must be an object")
+                # Checked here, a bad value would otherwise fail every request of its generate_batch group
+                sampling = validate_sampling(sampling)
+            except (KeyError, ValueError, TypeError) as e:
+                self._send_json(400, {"error": f"Bad request: {e}"})
+                return
+
+            request = batcher.submit(GenerationRequest(prompt, max_new_tokens, sampling))
+            if request.error is not None:
+                self._send_json(500, {"error": request.error})
+                return
+            self._send_json(200, {
+                "text": request.text,
+                "latency_ms": 1000 * (request.finished_at - request.enqueued_at),
+                "queue_ms": 1000 * (request.started_at - request.enqueued_at),
+                "batch_size": request.batch_size,
+                "queue_depth": request.queue_depth,
+            })
+
+        def log_message(self, format, *args):
+            # Per-batch lines are printed by the batcher instead of one line per HTTP request
+            pass
+
+    return GenerationHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve story completions from a saved checkpoint.")
+    parser.add_argument("--model", choices=sorted(MODEL_CLASSES), help="Required unless --checkpoint is an int8 checkpoint")
+    parser.add_argument("--checkpoint", required=True, help="torch.save({'model_state_dict': ...}) file")
+    parser.add_argument("--int8", action="store_true", help="Serve a dynamic int8 copy of the fp32 checkpoint")
+    parser.add_argument("--tokenizer", default="custom_tokenizer", help="Saved custom_tokenizer directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--num-threads", type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    if args.model is None:
+        # Checkpoints written by save_quantized_checkpoint know their model and config
+        try:
+            model, config = load_quantized_model(args.checkpoint)
+        except ValueError:
+            parser.error("--model is required for fp32 checkpoints")
+    else:
+        model, config = load_checkpoint_model(args.checkpoint, args.model, device='cpu')
+        if args.int8:
+            model = quantize_model(model)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    print(f"Loaded {args.model or 'int8 model'} from {args.checkpoint}")
+
+    batcher = DynamicBatcher(model, tokenizer, 'cpu', max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    batcher.start()
+
+    server = GenerationServer((args.host, args.port), make_handler(batcher, config['MAX_OUT_TOKENS']))
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped.")
+
+
+if __name__ == "__main__":
+    main()
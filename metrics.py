@@ -0,0 +1,116 @@
+import json
+import time
+import queue
+import threading
+
+
+class WandbSink:
+    def __init__(self):
+        # Only needed when wandb is one of the sinks
+        import wandb
+        self.wandb = wandb
+
+    def log(self, metrics, step):
+        self.wandb.log(metrics, step=step)
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    # One JSON object per flush, for offline runs
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def log(self, metrics, step):
+        self.file.write(json.dumps({"step": step, "time": time.time(), **metrics}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def make_metric_sinks(config):
+    """
+    Sinks named in config['METRICS_SINKS']: "wandb" and/or "jsonl" (written to config['METRICS_PATH']).
+    """
+    sinks = []
+    for name in config['METRICS_SINKS']:
+        if name == "wandb":
+            sinks.append(WandbSink())
+        elif name == "jsonl":
+            sinks.append(JsonlSink(config['METRICS_PATH']))
+        else:
+            raise ValueError(f"Unknown metrics sink {name!r}, expected 'wandb' or 'jsonl'")
+    return sinks
+
+
+class MetricsLogger:
+    """
+    Accumulates per-step metrics on the device and hands them to the sinks every every_steps steps or
+    every_secs seconds. Reading the values back (the device sync) and logging both happen on a background
+    thread, so the training loop never waits for either.
+    """
+    def __init__(self, sinks, every_steps=50, every_secs=10.0):
+        self.sinks = sinks
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.global_step = 0
+        self.sums = {}
+        self.counts = {}
+        self.last_flush_step = 0
+        self.last_flush_time = time.perf_counter()
+        # Values of the last flush, e.g. for a progress bar
+        self.latest = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, name, value):
+        # value is a (device) tensor, the sinks get its mean since the last flush
+        value = value.detach()
+        if name in self.sums:
+            self.sums[name] += value
+            self.counts[name] += 1
+        else:
+            self.sums[name] = value.clone()
+            self.counts[name] = 1
+
+    def step(self):
+        # Returns True when this step flushed
+        self.global_step += 1
+        if (self.global_step - self.last_flush_step >= self.every_steps
+                or time.perf_counter() - self.last_flush_time >= self.every_secs):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self.sums:
+            self.queue.put((self.global_step, self.sums, self.counts))
+            self.sums, self.counts = {}, {}
+        self.last_flush_step = self.global_step
+        self.last_flush_time = time.perf_counter()
+
+    def log(self, metrics):
+        # Plain Python values (e.g. epoch or validation metrics), logged at the current step
+        self.queue.put((self.global_step, dict(metrics), None))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            step, values, counts = item
+            if counts is not None:
+                values = {name: (value / counts[name]).item() for name, value in values.items()}
+            self.latest.update(values)
+            for sink in self.sinks:
+                sink.log(values, step)
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,460 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from generation import TokenBuffer, sample_next_token
+from batching import document_attention_mask
+from precision import autocast_context
+from torch.nn import TransformerDecoder, TransformerEncoder
+from torch.nn import TransformerEncoderLayer, TransformerDecoderLayer
+
+
+class GPT2FromScratch(nn.Module):
+    def __init__(self, config):
+        super(GPT2FromScratch, self).__init__()
+        self.embeddings = nn.Embedding(config["VOCAB_SIZE"], config["EMB_SIZE"])
+        self.blocks = nn.ModuleList([
+            nn.TransformerEncoderLayer(
+                d_model=config["EMB_SIZE"],
+                nhead=config["N_ATTENTION_HEADS"],
+                dim_feedforward=config["EMB_SIZE"] * 4,
+                activation='gelu'
+            )
+            for _ in range(config["N_DECODER_BLOCKS"])
+        ])
+        self.final_norm = nn.LayerNorm(config["EMB_SIZE"])
+        self.head = nn.Linear(config["EMB_SIZE"], config["VOCAB_SIZE"])
+        self.block_size = config.get("BLOCK_SIZE", 128)  # Define block size for context
+
+    @property
+    def output_layer(self):
+        # Vocabulary projection, applied to hidden_states chunk by chunk by chunked_cross_entropy
+        return self.head
+
+    def hidden_states(self, x):
+        # Final normalized activations, i.e. everything but the vocabulary projection
+        x = self.embeddings(x)
+        for block in self.blocks:
+            x = block(x)
+        return self.final_norm(x)
+
+    def forward(self, x):
+        return self.head(self.hidden_states(x))
+
+    def next_token_logits(self, last_tokens, positions=None):
+        # last_tokens holds the newest token of B independent prompts. They are fed as a single position
+        # with the prompts along the blocks' batch axis, so the prompts never attend to each other and
+        # every row gets the same logits it would get when generated on its own. The blocks have no
+        # positional information, so positions is unused.
+        return self(last_tokens.unsqueeze(0))[0]  # (B, VOCAB_SIZE)
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, use_cache=True, sampling=None, precision="fp32"):
+        self.eval()  # Ensure the model is in evaluation mode
+        # Preallocate the output sequence instead of concatenating on every step
+        buffer = TokenBuffer(idx, max_new_tokens)
+        for _ in self._decode(buffer, max_new_tokens, use_cache, sampling, precision):
+            pass
+        return buffer.tokens
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, use_cache=True, sampling=None, precision="fp32"):
+        # Same as generate, but yields the (B, 1) sampled ids right after every step
+        self.eval()  # Ensure the model is in evaluation mode
+        buffer = TokenBuffer(idx, max_new_tokens)
+        yield from self._decode(buffer, max_new_tokens, use_cache, sampling, precision)
+
+    def _decode(self, buffer, max_new_tokens, use_cache, sampling, precision):
+        for _ in range(max_new_tokens):
+            if use_cache:
+                # The blocks are not batch_first and get no mask, so self-attention runs across
+                # the batch rows of each position and never across time. The logits of the newest
+                # position therefore only depend on the newest column: the per-layer key/value
+                # cache of earlier positions is empty and only that column needs to be run.
+                idx_cond = buffer.window(1)
+            else:
+                # Crop idx to the last block_size tokens
+                idx_cond = buffer.window(self.block_size)
+            # Get the predictions
+            with autocast_context(precision, buffer.tokens.device):
+                logits = self(idx_cond)  # Only use logits (ignore loss)
+            # Focus only on the last time step, sampling always runs in fp32
+            logits = logits[:, -1, :].float()  # (B, VOCAB_SIZE)
+            # Pick the next token with the requested sampling strategy
+            idx_next = sample_next_token(logits, sampling, buffer.tokens)  # (B, 1)
+            # Write the sampled index into the running sequence
+            buffer.append(idx_next)  # (B, T+1)
+            yield idx_next
+
+
+class CausalSelfAttention(nn.Module):
+    """
+    Batch-first multi-head self-attention with a single fused QKV projection, computed by
+    F.scaled_dot_product_attention so that the flash / memory-efficient kernels are used where available.
+    """
+    def __init__(self, emb_size, n_heads, dropout):
+        super(CausalSelfAttention, self).__init__()
+        self.n_heads = n_heads
+        self.dropout = dropout
+        self.qkv = nn.Linear(emb_size, 3 * emb_size)
+        self.out_proj = nn.Linear(emb_size, emb_size)
+
+    def forward(self, x, attn_mask=None, past_key_value=None):
+        # x: (B, T, C). attn_mask: None for causal attention over x (or one new token over the cache),
+        # otherwise a (B, 1, T, S) boolean mask, True where a query may attend to a key
+        B, T, C = x.size()
+        q, k, v = self.qkv(x).split(C, dim=2)
+        q, k, v = (t.view(B, T, self.n_heads, C // self.n_heads).transpose(1, 2) for t in (q, k, v))  # (B, H, T, D)
+        if past_key_value is not None:
+            k = torch.cat([past_key_value[0], k], dim=2)
+            v = torch.cat([past_key_value[1], v], dim=2)
+        dropout_p = self.dropout if self.training else 0.0
+        if attn_mask is None:
+            y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=past_key_value is None and T > 1)
+        else:
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        y = y.transpose(1, 2).reshape(B, T, C)
+        return self.out_proj(y), (k, v)
+
+
+class CausalDecoderBlock(nn.Module):
+    """
+    Post-norm block computing the same as the nn.TransformerEncoderLayer blocks of GPT2FromScratch (GELU
+    feed-forward, same parameter names apart from the fused qkv), but with causal attention over the time
+    axis of batch-first inputs.
+    """
+    def __init__(self, emb_size, n_heads, dim_feedforward, dropout):
+        super(CausalDecoderBlock, self).__init__()
+        self.self_attn = CausalSelfAttention(emb_size, n_heads, dropout)
+        self.linear1 = nn.Linear(emb_size, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, emb_size)
+        self.norm1 = nn.LayerNorm(emb_size)
+        self.norm2 = nn.LayerNorm(emb_size)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x, attn_mask=None, past_key_value=None):
+        attn_output, present = self.self_attn(x, attn_mask, past_key_value)
+        x = self.norm1(x + self.dropout(attn_output))
+        x = self.norm2(x + self.dropout(self.linear2(self.dropout(F.gelu(self.linear1(x))))))
+        return x, present
+
+
+class CausalGPT2(nn.Module):
+    """
+    GPT2FromScratch built from CausalDecoderBlocks: (B, T) inputs are batch-first, every position attends
+    to itself and the positions before it, and learned position embeddings tell the positions apart.
+    With document_ids (packed windows, see PackedTokenDataset) attention also stays within every story.
+    GPT2FromScratch checkpoints are converted with convert_gpt2_state_dict.
+
+    past_key_values is the list of the (k, v) tensors of every block, returned with use_cache=True.
+    padding_mask (B, past + T), True for real tokens, lets left-padded rows share a batch: [PAD] keys are
+    never attended to and positions only count the real tokens.
+    """
+    # Checked by training.supports_document_ids before packed windows with document_ids are trained on
+    supports_document_ids = True
+
+    def __init__(self, config):
+        super(CausalGPT2, self).__init__()
+        self.embeddings = nn.Embedding(config["VOCAB_SIZE"], config["EMB_SIZE"])
+        self.position_embeddings = nn.Embedding(config["BLOCK_SIZE"], config["EMB_SIZE"])
+        self.blocks = nn.ModuleList([
+            CausalDecoderBlock(config["EMB_SIZE"], config["N_ATTENTION_HEADS"], config["EMB_SIZE"] * 4, config.get("DROPOUT", 0.1))
+            for _ in range(config["N_DECODER_BLOCKS"])
+        ])
+        self.final_norm = nn.LayerNorm(config["EMB_SIZE"])
+        self.head = nn.Linear(config["EMB_SIZE"], config["VOCAB_SIZE"])
+        self.block_size = config["BLOCK_SIZE"]
+
+    @property
+    def output_layer(self):
+        # Vocabulary projection, applied to hidden_states chunk by chunk by chunked_cross_entropy
+        return self.head
+
+    def _attention_mask(self, T, past_length, document_ids, padding_mask, device):
+        # None when plain causal attention (or a single new token over the cache) is all that is needed
+        if document_ids is not None:
+            return document_attention_mask(document_ids).unsqueeze(1)
+        if padding_mask is None and (past_length == 0 or T == 1):
+            return None
+        query_positions = torch.arange(past_length, past_length + T, device=device).unsqueeze(1)
+        key_positions = torch.arange(past_length + T, device=device).unsqueeze(0)
+        mask = (key_positions <= query_positions).unsqueeze(0).unsqueeze(0)  # (1, 1, T, S)
+        if padding_mask is not None:
+            # [PAD] queries still attend to themselves, so that their rows stay finite
+            mask = mask & (padding_mask[:, None, None, :] | (key_positions == query_positions))
+        return mask
+
+    def _run(self, x, past_key_values=None, document_ids=None, padding_mask=None):
+        past_length = past_key_values[0][0].size(2) if past_key_values is not None else 0
+        T = x.size(1)
+        if padding_mask is not None:
+            # Left-padded rows count their positions from their first real token
+            positions = (padding_mask.long().cumsum(dim=1) - 1).clamp(min=0)[:, past_length:]
+        else:
+            positions = torch.arange(past_length, past_length + T, device=x.device).unsqueeze(0)
+        x = self.embeddings(x) + self.position_embeddings(positions)
+        attn_mask = self._attention_mask(T, past_length, document_ids, padding_mask, x.device)
+        presents = []
+        for i, block in enumerate(self.blocks):
+            x, present = block(x, attn_mask, past_key_values[i] if past_key_values is not None else None)
+            presents.append(present)
+        return self.final_norm(x), presents
+
+    def hidden_states(self, x, document_ids=None):
+        # Final normalized activations, i.e. everything but the vocabulary projection
+        return self._run(x, document_ids=document_ids)[0]
+
+    def forward(self, x, past_key_values=None, use_cache=False, document_ids=None, padding_mask=None):
+        x, presents = self._run(x, past_key_values, document_ids, padding_mask)
+        logits = self.head(x)
+        if use_cache:
+            return logits, presents
+        return logits
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, use_cache=True, sampling=None, precision="fp32"):
+        self.eval()  # Ensure the model is in evaluation mode
+        # Preallocate the output sequence instead of concatenating on every step
+        buffer = TokenBuffer(idx, max_new_tokens)
+        for _ in self._decode(buffer, max_new_tokens, use_cache, sampling, precision):
+            pass
+        return buffer.tokens
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, use_cache=True, sampling=None, precision="fp32"):
+        # Same as generate, but yields the (B, 1) sampled ids right after every step
+        self.eval()  # Ensure the model is in evaluation mode
+        buffer = TokenBuffer(idx, max_new_tokens)
+        yield from self._decode(buffer, max_new_tokens, use_cache, sampling, precision)
+
+    def _decode(self, buffer, max_new_tokens, use_cache, sampling, precision):
+        past_key_values = None
+        for _ in range(max_new_tokens):
+            with autocast_context(precision, buffer.tokens.device):
+                if not use_cache:
+                    # Crop idx to the last block_size tokens
+                    logits = self(buffer.window(self.block_size))
+                elif past_key_values is None or past_key_values[0][0].size(2) >= self.block_size:
+                    # Encode the (cropped) prompt. Once the cache holds block_size positions, the last
+                    # block_size // 2 tokens are encoded again, so that happens every block_size // 2 steps
+                    window = self.block_size if past_key_values is None else self.block_size // 2
+                    logits, past_key_values = self(buffer.window(window), use_cache=True)
+                else:
+                    # Only the newest token, its keys and values are appended to the cache
+                    logits, past_key_values = self(buffer.window(1), past_key_values=past_key_values, use_cache=True)
+            # Focus only on the last time step, sampling always runs in fp32
+            logits = logits[:, -1, :].float()  # (B, VOCAB_SIZE)
+            # Pick the next token with the requested sampling strategy
+            idx_next = sample_next_token(logits, sampling, buffer.tokens)  # (B, 1)
+            # Write the sampled index into the running sequence
+            buffer.append(idx_next)  # (B, T+1)
+            yield idx_next
+
+
+def convert_gpt2_state_dict(state_dict, block_size):
+    """
+    CausalGPT2 state dict from a GPT2FromScratch one (e.g. a custom-21M.pt checkpoint). The in_proj weights of
+    the nn.TransformerEncoderLayer blocks are already in fused (q, k, v) order and become the qkv projection,
+    every other weight keeps its name. GPT2FromScratch had no positional information, so the position
+    embeddings start at zero. Its attention ran across the batch instead of causally over time, so the
+    converted model is a starting point for fine-tuning rather than an equivalent model.
+    """
+    converted = {}
+    for name, tensor in state_dict.items():
+        name = name.replace('self_attn.in_proj_weight', 'self_attn.qkv.weight').replace('self_attn.in_proj_bias', 'self_attn.qkv.bias')
+        converted[name] = tensor
+    embeddings = state_dict['embeddings.weight']
+    converted['position_embeddings.weight'] = embeddings.new_zeros(block_size, embeddings.size(1))
+    return converted
+
+
+class Transformer21MFinalSingleLayer(nn.Module):
+    def __init__(self, config=None):
+        super(Transformer21MFinalSingleLayer, self).__init__()
+
+        self.device = config['DEVICE']
+
+        # Embedding layer
+        self.embedding = nn.Embedding(config['VOCAB_SIZE'], config['EMB_SIZE']).to(self.device)
+
+        # Positional encoding
+        self.positional_encoding = nn.Parameter(torch.zeros(1, config['MAX_LENGTH'], config['EMB_SIZE'])).to(self.device)
+
+        encoder_layer = TransformerEncoderLayer(d_model=config['EMB_SIZE'], nhead=config['N_ATTENTION_HEADS'], dim_feedforward=config['DIM_FEEDFORWRD'], dropout=config['DROPOUT'])
+        decoder_layer = TransformerDecoderLayer(d_model=config['EMB_SIZE'], nhead=config['N_ATTENTION_HEADS'], dim_feedforward=config['DIM_FEEDFORWRD'], dropout=config['DROPOUT'])
+
+        self.transformer_encoder = TransformerEncoder(encoder_layer, num_layers=config['N_ENCODER_BLOCKS']).to(self.device)
+        self.transformer_decoder = TransformerDecoder(decoder_layer, num_layers=config['N_DECODER_BLOCKS']).to(self.device)
+
+        # Output linear layer
+        self.fc_out = nn.Linear(config['EMB_SIZE'], config['VOCAB_SIZE']).to(self.device)
+
+        self.logits = None
+
+        self.block_size = config['BLOCK_SIZE']
+
+    @property
+    def output_layer(self):
+        # Vocabulary projection, applied to hidden_states chunk by chunk by chunked_cross_entropy
+        return self.fc_out
+
+    def hidden_states(self, src):
+        # Decoder output of a training batch, i.e. forward without the vocabulary projection
+        src = src.to(self.device)
+        positions = torch.arange(src.size(1), device=src.device)
+        src = self.embedding(src) + self.positional_encoding[:, positions, :]
+        memory = self.transformer_encoder(src)
+        return self.transformer_decoder(src, memory)
+
+    def forward(self, src, past_key_values=None, use_cache=False):
+        # Move src to the correct device
+        src = src.to(self.device)
+
+        # Shift src and create tgt to be aligned in length with src
+        tgt = src.clone()
+
+        # The encoder and decoder layers are not batch_first and get no masks, so every attention
+        # (encoder self-attention, decoder self-attention and cross-attention) runs across the batch
+        # rows of a single position and never across time. The encoder memory and the decoder K/V of
+        # earlier positions are never read again, so the cache only has to remember how many positions
+        # were already processed to place the new tokens. Once the block_size window is full it slides,
+        # and the newest token keeps the last position, exactly like cropping idx to block_size.
+        past_length = past_key_values['seen_tokens'] if past_key_values is not None else 0
+        positions = torch.arange(past_length, past_length + src.size(1), device=src.device)
+        if past_key_values is not None:
+            positions = positions.clamp(max=self.block_size - 1)
+
+        # Embedding and positional encoding
+        src = self.embedding(src) + self.positional_encoding[:, positions, :]
+        tgt = self.embedding(tgt) + self.positional_encoding[:, positions, :]
+
+        # Pass through the encoder
+        memory = self.transformer_encoder(src)
+
+        # Pass through the decoder
+        output = self.transformer_decoder(tgt, memory)
+
+        # Output layer to vocab logits
+        logits = self.fc_out(output)
+
+        self.logits = logits
+
+        if use_cache:
+            return self.logits, {'seen_tokens': past_length + src.size(1)}
+
+        return self.logits # Shape: (batch_size, sequence_length, vocab_size)
+
+    def next_token_logits(self, last_tokens, positions):
+        # last_tokens holds the newest token of B independent prompts and positions the index of that
+        # token in its own prompt. They are fed as a single position with the prompts along the layers'
+        # batch axis, so the prompts never attend to each other and every row gets the same logits it
+        # would get when generated on its own.
+        positions = positions.clamp(max=self.block_size - 1)
+        x = (self.embedding(last_tokens.to(self.device)) + self.positional_encoding[0, positions, :]).unsqueeze(0)
+        memory = self.transformer_encoder(x)
+        output = self.transformer_decoder(x, memory)
+        return self.fc_out(output)[0]  # (B, VOCAB_SIZE)
+
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, use_cache=True, sampling=None, precision="fp32"):
+        self.eval()  # Ensure the model is in evaluation mode
+        # Preallocate the output sequence instead of concatenating on every step
+        buffer = TokenBuffer(idx, max_new_tokens)
+        for _ in self._decode(buffer, max_new_tokens, use_cache, sampling, precision):
+            pass
+        return buffer.tokens
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, use_cache=True, sampling=None, precision="fp32"):
+        # Same as generate, but yields the (B, 1) sampled ids right after every step
+        self.eval()  # Ensure the model is in evaluation mode
+        buffer = TokenBuffer(idx, max_new_tokens)
+        yield from self._decode(buffer, max_new_tokens, use_cache, sampling, precision)
+
+    def _decode(self, buffer, max_new_tokens, use_cache, sampling, precision):
+        past_key_values = None
+        for _ in range(max_new_tokens):
+            with autocast_context(precision, buffer.tokens.device):
+                if use_cache:
+                    # Encode the (cropped) prompt once, afterwards only the newest token
+                    idx_cond = buffer.window(self.block_size if past_key_values is None else 1)
+                    logits, past_key_values = self(idx_cond, past_key_values=past_key_values, use_cache=True)
+                else:
+                    # Crop idx to the last block_size tokens
+                    idx_cond = buffer.window(self.block_size)
+                    # Get the predictions
+                    logits = self(idx_cond)  # Only use logits (ignore loss)
+            # Focus only on the last time step, sampling always runs in fp32
+            logits = logits[:, -1, :].float()  # (B, VOCAB_SIZE)
+            # Pick the next token with the requested sampling strategy
+            idx_next = sample_next_token(logits, sampling, buffer.tokens)  # (B, 1)
+            # Write the sampled index into the running sequence
+            buffer.append(idx_next)  # (B, T+1)
+            yield idx_next
+
+
+# Hyperparameters of the trained models, used to rebuild them outside of the training scripts
+MODEL_CONFIGS = {
+    "GPT2FromScratch": {
+        "BLOCK_SIZE": 128,
+        "EMB_SIZE": 512,
+        "N_ATTENTION_HEADS": 8,
+        "N_DECODER_BLOCKS": 4,
+        "VOCAB_SIZE": 10000,
+        "MAX_OUT_TOKENS": 200,
+    },
+    "CausalGPT2": {
+        "BLOCK_SIZE": 128,
+        "EMB_SIZE": 512,
+        "N_ATTENTION_HEADS": 8,
+        "N_DECODER_BLOCKS": 4,
+        "VOCAB_SIZE": 10000,
+        "DROPOUT": 0.1,
+        "MAX_OUT_TOKENS": 200,
+    },
+    "Transformer21MFinalSingleLayer": {
+        "BLOCK_SIZE": 128,
+        "EMB_SIZE": 558,
+        "N_ATTENTION_HEADS": 18,
+        "N_ENCODER_BLOCKS": 1,
+        "N_DECODER_BLOCKS": 1,
+        "DIM_FEEDFORWRD": 4096,
+        "VOCAB_SIZE": 10000,
+        "DROPOUT": 0.1,
+        "MAX_LENGTH": 512,
+        "MAX_OUT_TOKENS": 200,
+    },
+}
+
+MODEL_CLASSES = {
+    "GPT2FromScratch": GPT2FromScratch,
+    "CausalGPT2": CausalGPT2,
+    "Transformer21MFinalSingleLayer": Transformer21MFinalSingleLayer,
+}
+
+
+def build_model(model_name, device='cpu', config=None):
+    # model_name with its MODEL_CONFIGS hyperparameters updated with config, returns (model, config)
+    config = {**MODEL_CONFIGS[model_name], **(config or {}), "DEVICE": device}
+    return MODEL_CLASSES[model_name](config).to(device), config
+
+
+def load_model_state(model, state_dict, model_name):
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    # Transformer21MFinalSingleLayer only registers positional_encoding as a parameter on CPU, so checkpoints
+    # trained on GPU do not have it (it stayed zeros during training there)
+    missing = [key for key in missing if key != 'positional_encoding']
+    if missing or unexpected:
+        raise RuntimeError(f"Checkpoint does not match {model_name}: missing {missing}, unexpected {unexpected}")
+
+
+def load_checkpoint_model(checkpoint_path, model_name, device='cpu', config=None):
+    """
+    Rebuilds model_name with its MODEL_CONFIGS hyperparameters (updated with config) and loads the
+    'model_state_dict' of a checkpoint saved by the training scripts. Returns (model, config).
+    """
+    model, config = build_model(model_name, device, config)
+    checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=True)
+    load_model_state(model, checkpoint['model_state_dict'], model_name)
+    model.eval()
+    return model, config
@@ -0,0 +1,24 @@
+import torch
+from contextlib import nullcontext
+
+# "fp32": plain float32, "bf16": bfloat16 autocast (CPU or GPU), "fp16": float16 autocast with GradScaler (GPU only)
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+
+def autocast_context(precision, device):
+    """
+    Context manager running the forward pass in the requested precision on device ('cpu' or 'cuda').
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    device_type = torch.device(device).type
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError("fp16 precision needs a GPU, use bf16 on CPU")
+    if precision == "fp32":
+        return nullcontext()
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16 if precision == "bf16" else torch.float16)
+
+
+def make_grad_scaler(precision, device):
+    # Loss scaling is only needed for fp16, the scaler is a no-op otherwise
+    return torch.amp.GradScaler(torch.device(device).type, enabled=precision == "fp16")
@@ -0,0 +1,47 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from models import build_model, load_model_state
+
+
+def quantize_model(model):
+    """
+    CPU int8 copy of model: every nn.Linear (the FFNs and the VOCAB_SIZE head / fc_out) gets int8 weights
+    and dynamically quantized activations. The attention in/out projections are kept in fp32 by
+    nn.MultiheadAttention (the qkv / out_proj of CausalGPT2 are plain nn.Linear and quantized too),
+    the embeddings stay fp32 as well.
+    """
+    model = copy.deepcopy(model).to('cpu').eval()
+    # Transformer21MFinalSingleLayer moves its inputs to self.device, and its positional_encoding is a
+    # plain tensor (not moved by .to) when the model was built on GPU
+    if hasattr(model, 'device'):
+        model.device = 'cpu'
+    if isinstance(getattr(model, 'positional_encoding', None), torch.Tensor):
+        model.positional_encoding = model.positional_encoding.to('cpu')
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized_checkpoint(model, model_name, config, path):
+    # Quantizes model and saves it with what load_quantized_model needs to rebuild it
+    quantized_model = quantize_model(model)
+    torch.save({
+        'model_state_dict': quantized_model.state_dict(),
+        'model_name': model_name,
+        'config': {key: value for key, value in config.items() if key != 'DEVICE'},
+        'quantization': 'dynamic_int8',
+    }, path)
+    return quantized_model
+
+
+def load_quantized_model(path):
+    """
+    Loads a checkpoint written by save_quantized_checkpoint on CPU. Returns (model, config).
+    """
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    if checkpoint.get('quantization') != 'dynamic_int8':
+        raise ValueError(f"{path} is not a checkpoint written by save_quantized_checkpoint")
+    model, config = build_model(checkpoint['model_name'], 'cpu', checkpoint['config'])
+    model = quantize_model(model)
+    load_model_state(model, checkpoint['model_state_dict'], checkpoint['model_name'])
+    return model, config
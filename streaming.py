@@ -0,0 +1,95 @@
+import random
+import itertools
+import numpy as np
+import torch
+from torch.utils import data
+
+
+class StreamingPackedDataset(data.IterableDataset):
+    """
+    Packed BLOCK_SIZE windows over a stream of stories, for corpora that should never be loaded or indexed
+    as a whole (e.g. load_dataset("roneneldan/TinyStories", split="train", streaming=True)).
+
+    Every DataLoader worker reads its own part of the stories, shuffles them in a buffer of at most
+    shuffle_buffer stories, tokenizes them in batches and packs them like PackedTokenDataset: stories joined
+    by <eos>, windows overlapping by one token. Memory stays constant whatever the corpus size.
+
+    The order only depends on seed, the epoch and the number of workers. The training loop keeps
+    batches_seen up to date, so state_dict() is the position in the stream, and a dataset restored with
+    load_state_dict() (with the same batch_size and num_workers) skips the windows that were already
+    trained on when it is iterated again. It yields exactly the remaining batches; with several workers
+    their order can be rotated by a few batches, since a new DataLoader starts again with worker 0.
+    """
+    def __init__(self, stories, tokenizer, block_size, batch_size, shuffle_buffer=10000, seed=0, tokenize_batch_size=256):
+        self.stories = stories
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.tokenize_batch_size = tokenize_batch_size
+        self.eos_token_id = tokenizer.convert_tokens_to_ids('<eos>')
+        self.epoch = 0
+        self.batches_seen = 0
+
+    def set_epoch(self, epoch):
+        # A resumed epoch keeps its position, a new one starts from the beginning of the stream
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batches_seen = 0
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'batches_seen': self.batches_seen}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.batches_seen = state_dict['batches_seen']
+
+    def _worker_stories(self, worker_id, num_workers):
+        if isinstance(self.stories, data.IterableDataset):
+            # A streaming HuggingFace dataset splits its file shards between the DataLoader workers itself
+            return iter(self.stories)
+        return itertools.islice(self.stories, worker_id, None, num_workers)
+
+    def _shuffled(self, stories, rng):
+        # Bounded shuffle buffer: every new story replaces a random one of the buffer, which is yielded
+        buffer = []
+        for story in stories:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(story)
+                continue
+            i = rng.randrange(self.shuffle_buffer)
+            yield buffer[i]
+            buffer[i] = story
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _windows(self, stories):
+        tokens = np.empty(0, dtype=np.int64)
+        while True:
+            texts = [story['text'] for story in itertools.islice(stories, self.tokenize_batch_size)]
+            if not texts:
+                break
+            ids = self.tokenizer(texts)['input_ids']
+            tokens = np.concatenate([tokens] + [np.array(story_ids + [self.eos_token_id], dtype=np.int64) for story_ids in ids])
+            # Consecutive windows share one token, as in PackedTokenDataset
+            n_windows = max((len(tokens) - 1) // (self.block_size - 1), 0)
+            for i in range(n_windows):
+                start = i * (self.block_size - 1)
+                yield tokens[start:start + self.block_size]
+            tokens = tokens[n_windows * (self.block_size - 1):]
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        rng = random.Random(f"{self.seed}-{self.epoch}-{worker_id}")
+
+        stories = self._worker_stories(worker_id, num_workers)
+        if self.shuffle_buffer:
+            stories = self._shuffled(stories, rng)
+
+        # The DataLoader takes one batch from every worker in turn, so this worker produced every
+        # num_workers-th of the batches already seen
+        skip = self.batch_size * len(range(worker_id, self.batches_seen, num_workers))
+        for window in itertools.islice(self._windows(iter(stories)), skip, None):
+            yield {'input_ids': torch.from_numpy(window.copy())}
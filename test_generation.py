@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, decoders
+
+from generation import IncrementalDecoder
+
+PROMPTS = [
+    "I do not know. It's fine, isn't it?",
+    "We're here! They've gone, don't you see?",
+    "Mom said: do not run. Do not, do not! I'm sure he's 'fine'.",
+    "Lily smiled . then she said , \" I do not want to go home ! \"",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    # Same setup as custom_tokenizer: WordLevel words, Whitespace pre-tokenizer, WordPiece decoder cleanup
+    words = {word for prompt in PROMPTS for word in pre_tokenizers.Whitespace().pre_tokenize_str(prompt.lower())}
+    vocab = {word: index for index, word in enumerate(sorted(word for word, _ in words))}
+    vocab["[UNK]"] = len(vocab)
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.decoder = decoders.WordPiece()
+    custom_tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer)
+    custom_tokenizer.add_special_tokens({'additional_special_tokens': ['<sos>', '<eos>']})
+    return custom_tokenizer
+
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+@pytest.mark.parametrize("context_tokens", [2, 8])
+def test_streamed_text_matches_full_decode(tokenizer, prompt, context_tokens):
+    all_ids = tokenizer.encode(prompt) + tokenizer.convert_tokens_to_ids(['<eos>'])
+    decoder = IncrementalDecoder(tokenizer, context_tokens=context_tokens)
+    pieces = [decoder.push(token_id) for token_id in all_ids]
+    pieces.append(decoder.flush())
+    assert "".join(pieces) == tokenizer.decode(all_ids, skip_special_tokens=True)
@@ -0,0 +1,176 @@
+"""
+Offline tokenization of TinyStories into flat uint16 token shards.
+
+Every story is tokenized once with the saved custom_tokenizer (no padding, no truncation) and appended to
+<split>_<n>.bin shards. <split>_<n>.idx.npy holds the int64 start offset of every story in its shard (plus
+the end of the last one), and manifest.json records the shards together with a hash of the tokenizer so
+shards written with another vocabulary are never read by mistake.
+
+    python token_shards.py --tokenizer custom_tokenizer --out-dir /kaggle/working/token_shards
+
+TokenShardDataset reads the shards back through np.memmap: nothing is loaded at startup and every worker
+only touches the pages of the stories it reads.
+"""
+
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+from torch.utils import data
+
+MANIFEST_NAME = "manifest.json"
+TOKEN_DTYPE = np.uint16
+
+
+def tokenizer_hash(tokenizer):
+    # Vocabulary, normalizer, pre-tokenizer and special tokens all change the token ids. Truncation and
+    # padding are left out: the fast tokenizer stores whatever the last call used
+    tokenizer_state = json.loads(tokenizer.backend_tokenizer.to_str())
+    tokenizer_state.pop('truncation', None)
+    tokenizer_state.pop('padding', None)
+    tokenizer_state['special_tokens_map'] = tokenizer.special_tokens_map
+    return hashlib.sha256(json.dumps(tokenizer_state, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def read_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def write_token_shards(splits, tokenizer, out_dir, shard_tokens=100_000_000, batch_size=1000):
+    """
+    Tokenizes every split of splits ({name: dataset with a "text" column}) into uint16 shards of at most
+    shard_tokens tokens in out_dir. Does nothing if out_dir already holds shards for the same tokenizer.
+    Returns the manifest.
+    """
+    if len(tokenizer) > np.iinfo(TOKEN_DTYPE).max + 1:
+        raise ValueError(f"Vocabulary of {len(tokenizer)} tokens does not fit in {np.dtype(TOKEN_DTYPE).name}")
+
+    token_hash = tokenizer_hash(tokenizer)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        manifest = read_manifest(out_dir)
+        if manifest['tokenizer_hash'] == token_hash and set(splits) <= set(manifest['splits']):
+            print(f"Token shards for tokenizer {token_hash} already in {out_dir}")
+            return manifest
+    os.makedirs(out_dir, exist_ok=True)
+
+    manifest = {
+        'tokenizer_hash': token_hash,
+        'vocab_size': len(tokenizer),
+        'pad_token_id': tokenizer.pad_token_id,
+        'dtype': np.dtype(TOKEN_DTYPE).name,
+        'splits': {},
+    }
+    for split, dataset in splits.items():
+        shards = []
+        tokens, offsets = [], [0]
+
+        def flush():
+            name = f"{split}_{len(shards):04d}"
+            np.concatenate(tokens).astype(TOKEN_DTYPE).tofile(os.path.join(out_dir, name + ".bin"))
+            np.save(os.path.join(out_dir, name + ".idx.npy"), np.array(offsets, dtype=np.int64))
+            shards.append({'tokens': name + ".bin", 'offsets': name + ".idx.npy", 'n_docs': len(offsets) - 1, 'n_tokens': offsets[-1]})
+            tokens.clear()
+            del offsets[1:]
+
+        for start in range(0, len(dataset), batch_size):
+            for ids in tokenizer(dataset[start:start+batch_size]["text"])["input_ids"]:
+                if offsets[-1] + len(ids) > shard_tokens and len(offsets) > 1:
+                    flush()
+                tokens.append(np.asarray(ids, dtype=np.int64))
+                offsets.append(offsets[-1] + len(ids))
+        if len(offsets) > 1:
+            flush()
+
+        manifest['splits'][split] = shards
+        print(f"{split}: {sum(s['n_docs'] for s in shards)} stories, {sum(s['n_tokens'] for s in shards)} tokens in {len(shards)} shards")
+
+    # The manifest is written last, so an interrupted run never looks complete
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+class TokenShardDataset(data.Dataset):
+    """
+    Stories of one split of the token shards in shard_dir, returned like tokenize_function does:
+    {'input_ids': LongTensor of block_size}, truncated and right-padded with [PAD]. With padding=False
+    the stories are only truncated, for a collate function that pads every batch itself.
+    """
+    def __init__(self, shard_dir, split, tokenizer, block_size, padding=True):
+        manifest = read_manifest(shard_dir)
+        if manifest['tokenizer_hash'] != tokenizer_hash(tokenizer):
+            raise ValueError(f"Token shards in {shard_dir} were written with another tokenizer, rebuild them with token_shards.py")
+        if split not in manifest['splits']:
+            raise ValueError(f"No {split!r} split in {shard_dir}, available: {sorted(manifest['splits'])}")
+
+        self.shard_dir = shard_dir
+        self.shards = manifest['splits'][split]
+        self.block_size = block_size
+        self.padding = padding
+        self.pad_token_id = manifest['pad_token_id']
+        # First story index of every shard
+        self.shard_starts = np.cumsum([0] + [shard['n_docs'] for shard in self.shards])
+        # Opened lazily, so every DataLoader worker maps the files itself instead of receiving pickled arrays
+        self._tokens = None
+        self._offsets = None
+
+    def _open(self):
+        self._tokens = [np.memmap(os.path.join(self.shard_dir, s['tokens']), dtype=TOKEN_DTYPE, mode='r') for s in self.shards]
+        self._offsets = [np.load(os.path.join(self.shard_dir, s['offsets']), mmap_mode='r') for s in self.shards]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tokens'] = state['_offsets'] = None
+        return state
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def lengths(self):
+        # Length of every (truncated) story, read from the offsets only
+        if self._offsets is None:
+            self._open()
+        return np.concatenate([np.diff(offsets) for offsets in self._offsets]).clip(max=self.block_size)
+
+    def document(self, idx):
+        # Token ids of story idx as a read-only uint16 view into the shard
+        if self._tokens is None:
+            self._open()
+        shard = int(np.searchsorted(self.shard_starts, idx, side='right')) - 1
+        offsets = self._offsets[shard]
+        local = idx - self.shard_starts[shard]
+        return self._tokens[shard][offsets[local]:offsets[local + 1]]
+
+    def __getitem__(self, idx):
+        ids = self.document(idx)[:self.block_size]
+        if not self.padding:
+            return {'input_ids': torch.from_numpy(ids.astype(np.int64))}
+        input_ids = torch.full((self.block_size,), self.pad_token_id, dtype=torch.long)
+        input_ids[:len(ids)] = torch.from_numpy(ids.astype(np.int64))
+        return {'input_ids': input_ids}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize TinyStories once into uint16 memory-mapped shards.")
+    parser.add_argument("--tokenizer", default="custom_tokenizer", help="Saved custom_tokenizer directory")
+    parser.add_argument("--out-dir", required=True)
+    parser.add_argument("--splits", nargs="+", default=["train", "validation"])
+    parser.add_argument("--shard-tokens", type=int, default=100_000_000)
+    args = parser.parse_args()
+
+    from datasets import load_dataset
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    dataset = load_dataset("roneneldan/TinyStories")
+    write_token_shards({split: dataset[split] for split in args.splits}, tokenizer, args.out_dir, shard_tokens=args.shard_tokens)
+
+
+if __name__ == "__main__":
+    main()
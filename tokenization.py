@@ -0,0 +1,38 @@
+import os
+import json
+import hashlib
+from token_shards import tokenizer_hash
+
+
+def tokenization_cache_key(dataset, tokenizer, block_size, padding):
+    """
+    Content hash of everything the tokenized rows depend on: the rows themselves (the fingerprint of the
+    selected split, stable for a fixed split seed), the tokenizer (its vocabulary, i.e. vocab_dict_v2,
+    normalizer, pre-tokenizer and special tokens), BLOCK_SIZE and the padding mode.
+    """
+    key = json.dumps([dataset._fingerprint, tokenizer_hash(tokenizer), block_size, padding])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def tokenize_dataset(dataset, tokenizer, block_size, cache_dir, padding="max_length", num_proc=None):
+    """
+    dataset.map(tokenize_function) split over num_proc worker processes (all the CPUs by default), cached in
+    cache_dir under tokenization_cache_key. A re-run with the same rows, tokenizer and BLOCK_SIZE loads the
+    cached Arrow files instead of tokenizing again.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_key = tokenization_cache_key(dataset, tokenizer, block_size, padding)
+    num_proc = num_proc or os.cpu_count()
+
+    def tokenize_function(examples):
+        return tokenizer(examples["text"], padding=padding, truncation=True, max_length=block_size)
+
+    return dataset.map(
+        tokenize_function,
+        batched=True,
+        num_proc=num_proc if num_proc > 1 else None,
+        cache_file_name=os.path.join(cache_dir, f"tokenized_{cache_key}.arrow"),
+        load_from_cache_file=True,
+        new_fingerprint=cache_key,
+        desc="Tokenizing"
+    )
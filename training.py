@@ -0,0 +1,347 @@
+import copy
+import math
+import time
+import itertools
+import contextlib
+import torch
+import torch.distributed as dist
+from tqdm import tqdm
+from torch.utils.checkpoint import checkpoint
+from precision import autocast_context, make_grad_scaler
+from batching import DevicePrefetcher
+from metrics import MetricsLogger, make_metric_sinks
+from checkpointing import CheckpointManager, BestWeights, rng_state, set_rng_state
+
+
+def chunked_cross_entropy(hidden, output_layer, targets, loss_fn, chunk_size):
+    """
+    loss_fn (with reduction='sum') of output_layer(hidden) against targets, computed chunk_size rows at a
+    time. Every chunk is checkpointed: its (chunk_size, VOCAB_SIZE) logits are freed right after its loss
+    and recomputed during the backward pass, so the full logits tensor never exists.
+    """
+    def chunk_loss(hidden_chunk, target_chunk):
+        return loss_fn(output_layer(hidden_chunk).float(), target_chunk)
+
+    loss = 0
+    for start in range(0, hidden.size(0), chunk_size):
+        hidden_chunk = hidden[start:start + chunk_size]
+        target_chunk = targets[start:start + chunk_size]
+        if torch.is_grad_enabled():
+            loss = loss + checkpoint(chunk_loss, hidden_chunk, target_chunk, use_reentrant=False)
+        else:
+            loss = loss + chunk_loss(hidden_chunk, target_chunk)
+    return loss
+
+
+def sequence_loss_sum(model, sources, targets, config, loss_fn, document_ids=None):
+    """
+    Summed loss_fn (reduction='sum') of the model's predictions for sources against targets, with the
+    forward pass run in config['PRECISION']. With config['LOSS_CHUNK_SIZE'] the vocabulary projection
+    goes through chunked_cross_entropy. document_ids (packed windows with DOCUMENT_MASK) are passed on
+    to the model, which keeps attention within every story (CausalGPT2).
+    """
+    model_kwargs = {} if document_ids is None else {'document_ids': document_ids}
+    with autocast_context(config['PRECISION'], config['DEVICE']):
+        if config.get('LOSS_CHUNK_SIZE'):
+            hidden = model.hidden_states(sources, **model_kwargs)
+            hidden = hidden.reshape(-1, hidden.size(-1))
+            return chunked_cross_entropy(hidden, model.output_layer, targets.reshape(-1), loss_fn, config['LOSS_CHUNK_SIZE'])
+        logits = model(sources, **model_kwargs)
+    # Loss in fp32, the reduced precision logits are only used for the matmuls
+    return loss_fn(logits.float().view(-1, config['VOCAB_SIZE']), targets.reshape(-1))
+
+
+def supports_document_ids(model):
+    """
+    Whether model (or the model inside a DistributedDataParallel, torch.compile or PEFT wrapper) takes the
+    document_ids of packed windows, i.e. is a CausalGPT2.
+    """
+    return any(getattr(module, 'supports_document_ids', False) for module in model.modules())
+
+
+def train_step(model, batch, optimizer, config, loss_fn, scaler):
+    """
+    One optimizer step on a batch of input_ids, with the forward pass run in config['PRECISION'].
+    With config['MICRO_BATCH_SIZE'] the batch is split into micro-batches of that many rows whose gradients
+    are accumulated before the step, so peak memory depends on the micro-batch and not on the batch size.
+    Every micro-batch is weighted by its share of the batch's non-ignored targets. For models whose rows
+    are independent (CausalGPT2) the gradients are those of the whole batch; the other models are not
+    batch_first, so their attention runs across the rows of a micro-batch only. Returns the (fp32) loss tensor.
+    """
+    sources = batch['input_ids'].to(config['DEVICE'])
+    targets = sources[:, 1:].clone()  # Shift for language model prediction
+    sources = sources[:, :-1]  # Remove last token from source
+    document_ids = batch['document_ids'].to(config['DEVICE'])[:, :-1] if 'document_ids' in batch else None
+
+    # Same loss (ignore_index, label smoothing, ...) summed over the targets, divided by the batch's count
+    sum_loss_fn = copy.copy(loss_fn)
+    sum_loss_fn.reduction = 'sum'
+    n_targets = (targets != loss_fn.ignore_index).sum().clamp(min=1)
+    micro_batch_size = config.get('MICRO_BATCH_SIZE') or sources.size(0)
+
+    optimizer.zero_grad()
+    loss = torch.zeros((), device=sources.device)
+    for start in range(0, sources.size(0), micro_batch_size):
+        # A DistributedDataParallel model all-reduces the gradients in the last micro-batch's backward only
+        last = start + micro_batch_size >= sources.size(0)
+        with model.no_sync() if hasattr(model, 'no_sync') and not last else contextlib.nullcontext():
+            micro_documents = document_ids[start:start + micro_batch_size] if document_ids is not None else None
+            micro_loss = sequence_loss_sum(model, sources[start:start + micro_batch_size], targets[start:start + micro_batch_size], config, sum_loss_fn, micro_documents) / n_targets
+            scaler.scale(micro_loss).backward()
+        loss += micro_loss.detach()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss
+
+
+@torch.no_grad()
+def eval_model(training_model, val_loader, config):
+    """
+    Token-weighted validation loss over the first config['EVAL_ITER'] distinct batches of val_loader, or over
+    all of them when EVAL_ITER is None. The loss and token counts are summed on the device and read back once.
+    Returns a dict with the mean loss per (non-pad) target token, the perplexity and the number of tokens.
+    """
+    training_model.eval()
+    val_loss_fn = torch.nn.CrossEntropyLoss(ignore_index=config['PAD_TOKEN_ID'], reduction='sum')
+    total_loss = torch.zeros((), device=config['DEVICE'])
+    total_tokens = torch.zeros((), dtype=torch.long, device=config['DEVICE'])
+    for k, batch in enumerate(DevicePrefetcher(val_loader, config['DEVICE'])):
+        if config['EVAL_ITER'] is not None and k == config['EVAL_ITER']:
+            break
+        s_val = batch['input_ids'].to(config['DEVICE'])  # Access 'input_ids' from the batch
+        t_val = s_val[:, 1:]  # Shift for language model prediction
+        s_val = s_val[:, :-1]  # Remove last token from source
+        d_val = batch['document_ids'].to(config['DEVICE'])[:, :-1] if 'document_ids' in batch else None
+
+        # Summed loss over the real targets, [PAD] targets are ignored. Evaluated in micro-batches (and
+        # vocabulary chunks) like the training steps, so it fits in the same memory.
+        micro_batch_size = config.get('MICRO_BATCH_SIZE') or s_val.size(0)
+        for start in range(0, s_val.size(0), micro_batch_size):
+            micro_documents = d_val[start:start + micro_batch_size] if d_val is not None else None
+            total_loss += sequence_loss_sum(training_model, s_val[start:start + micro_batch_size], t_val[start:start + micro_batch_size], config, val_loss_fn, micro_documents)
+        total_tokens += (t_val != config['PAD_TOKEN_ID']).sum()
+
+    training_model.train()
+    val_loss = (total_loss / total_tokens.clamp(min=1)).item()
+    return {'loss': val_loss, 'perplexity': math.exp(min(val_loss, 100)), 'tokens': total_tokens.item()}
+
+
+def train_model(model, train_loader, val_loader, optimizer, config, loss_fn):
+    """
+    Trains the model and logs the training and validation losses, with progress tracking using tqdm.
+    The per-step values stay on the device and are logged to config['METRICS_SINKS'] every
+    config['LOG_EVERY_STEPS'] steps or config['LOG_EVERY_SECS'] seconds, so steps never wait for a sync.
+
+    With config['CHECKPOINT_DIR'] the full training state is checkpointed every CHECKPOINT_EVERY_STEPS steps
+    and after every epoch: model, optimizer, grad scaler, position in the data, RNG states and the early
+    stopping counters. With config['RESUME'] training continues from the latest checkpoint exactly as if it
+    had never stopped: the epoch's batch order is rebuilt from the RNG states of its start and the batches
+    already trained on are skipped.
+
+    The validation loss is computed every config['EVAL_EVERY_STEPS'] steps, or after every epoch when it is
+    None, and PATIENCE counts evaluations without improvement. The weights of the best evaluation are kept in
+    a BestWeights snapshot and loaded back into model when training ends, early stopped or not.
+    """
+
+    if any(getattr(loader.dataset, 'document_ids', False) for loader in (train_loader, val_loader)) and not supports_document_ids(model):
+        raise ValueError(f"DOCUMENT_MASK needs a model that takes document_ids (CausalGPT2), got {type(model).__name__}")
+
+    # In a distributed run (see distributed.py) only rank 0 prints, logs and writes checkpoints
+    main_process = not dist.is_initialized() or dist.get_rank() == 0
+    log = print if main_process else (lambda *args: None)
+
+    best_val_loss = float('inf')
+    patience_counter = 0
+    step = 0
+    stop = False
+    best_weights = BestWeights(model)
+    scaler = make_grad_scaler(config['PRECISION'], config['DEVICE'])
+    metrics = MetricsLogger(make_metric_sinks(config) if main_process else [], config['LOG_EVERY_STEPS'], config['LOG_EVERY_SECS'])
+    checkpoints = CheckpointManager(config['CHECKPOINT_DIR'], config['KEEP_CHECKPOINTS']) if config['CHECKPOINT_DIR'] else None
+    # Streaming datasets track their own position, map-style ones are positioned by skipping batches
+    streaming = hasattr(train_loader.dataset, 'batches_seen')
+    # LengthBucketSampler draws the batch order from its own generator
+    batch_sampler = train_loader.batch_sampler if hasattr(train_loader.batch_sampler, 'state_dict') else None
+
+    def training_state(epoch, batch_in_epoch, epoch_start_state, epoch_totals):
+        return {
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
+            'precision': config['PRECISION'],
+            'epoch': epoch,
+            'batch_in_epoch': batch_in_epoch,
+            'step': step,
+            'best_val_loss': best_val_loss,
+            'patience_counter': patience_counter,
+            'best_weights': best_weights.state_dict(),
+            'rng': rng_state(),
+            'epoch_start': epoch_start_state,
+            'dataset_state': train_loader.dataset.state_dict() if streaming else None,
+            'epoch_totals': epoch_totals
+        }
+
+    start_epoch, start_batch, resume_state = 0, 0, None
+    if config['RESUME'] and checkpoints is not None:
+        resume_state = checkpoints.load_latest()
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model_state_dict'])
+        optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+        scaler.load_state_dict(resume_state['scaler_state_dict'])
+        start_epoch, start_batch, step = resume_state['epoch'], resume_state['batch_in_epoch'], resume_state['step']
+        best_val_loss, patience_counter = resume_state['best_val_loss'], resume_state['patience_counter']
+        best_weights.load_state_dict(resume_state['best_weights'])
+        metrics.global_step = step
+        if streaming:
+            train_loader.dataset.load_state_dict(resume_state['dataset_state'])
+        # Back to the start of the interrupted epoch, so its loader draws the same batch order
+        set_rng_state(resume_state['epoch_start']['rng'])
+        if batch_sampler is not None:
+            batch_sampler.load_state_dict(resume_state['epoch_start']['sampler'])
+        log(f"Resumed from {checkpoints.latest()} at epoch {start_epoch+1}, batch {start_batch}")
+        if patience_counter >= config['PATIENCE']:
+            log("Early stopping was already triggered.")
+            start_epoch = config['EPOCHS']
+
+    def validate(label):
+        # Updates the early stopping counters, returns True when training should stop
+        nonlocal best_val_loss, patience_counter
+        val_metrics = eval_model(model, val_loader, config)
+        val_loss = val_metrics['loss']
+        log(f"Validation loss after {label}: {val_loss} (perplexity {val_metrics['perplexity']:.2f} over {val_metrics['tokens']} tokens)")
+        metrics.log({"val_loss": val_loss, "val_perplexity": val_metrics['perplexity']})
+
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            patience_counter = 0
+            best_weights.update(model)
+            log(f"New best validation loss: {val_loss}.")
+        else:
+            patience_counter += 1
+            log(f"No improvement in validation loss. Patience counter: {patience_counter}")
+        return patience_counter >= config['PATIENCE']
+
+    try:
+        for epoch in range(start_epoch, config['EPOCHS']):
+            model.train()
+            if hasattr(train_loader.dataset, 'set_epoch'):
+                # Streaming datasets shuffle every epoch differently and track their position in the stream
+                train_loader.dataset.set_epoch(epoch)
+            if hasattr(train_loader.sampler, 'set_epoch'):
+                # DistributedSampler: a different shuffle of every rank's shard every epoch
+                train_loader.sampler.set_epoch(epoch)
+            epoch_start_state = {'rng': rng_state(), 'sampler': batch_sampler.state_dict() if batch_sampler is not None else None}
+            # The resumed epoch continues its sums, later epochs start from zero
+            epoch_totals = resume_state['epoch_totals'] if start_batch else (0.0, 0, 0)
+            epoch_loss = torch.tensor(epoch_totals[0], device=config['DEVICE'])
+            # Tokens that are not [PAD], the only ones the loss is computed on, out of all the target positions
+            epoch_real_tokens = torch.tensor(epoch_totals[1], device=config['DEVICE'])
+            epoch_total_tokens = epoch_totals[2]
+            epoch_start = time.perf_counter()
+
+            # The next batch is copied to the GPU while the current one is trained on
+            epoch_progress = tqdm(DevicePrefetcher(train_loader, config['DEVICE']), desc=f"Training Epoch {epoch+1}/{config['EPOCHS']}: ", leave=False, disable=not main_process)
+            batches = enumerate(epoch_progress)
+            if start_batch and not streaming:
+                # Same order as before the interruption, without the batches that were already trained on
+                batches = itertools.islice(batches, start_batch, None)
+            # Only the first epoch of a resumed run starts in the middle
+            b_idx, resume_rng, start_batch = start_batch - 1, resume_state['rng'] if start_batch else None, 0
+
+            for b_idx, batch in batches:
+                if resume_rng is not None:
+                    # The order is drawn, continue with the random state of the interrupted step (dropout)
+                    set_rng_state(resume_rng)
+                    resume_rng = None
+                loss = train_step(model, batch, optimizer, config, loss_fn, scaler)
+                step += 1
+                metrics.add("loss", loss)
+                epoch_loss += loss.detach()
+                epoch_real_tokens += (batch['input_ids'][:, 1:] != config['PAD_TOKEN_ID']).sum()
+                epoch_total_tokens += batch['input_ids'][:, 1:].numel()
+
+                if streaming:
+                    train_loader.dataset.batches_seen += 1
+
+                if metrics.step() and 'loss' in metrics.latest:
+                    # Mean loss of the last flushed steps, read back by the logging thread
+                    epoch_progress.set_postfix(training_loss=metrics.latest['loss'])
+
+                if config['EVAL_EVERY_STEPS'] and step % config['EVAL_EVERY_STEPS'] == 0:
+                    stop = validate(f"{step} steps")
+
+                if checkpoints is not None and main_process and step % config['CHECKPOINT_EVERY_STEPS'] == 0:
+                    epoch_totals = (epoch_loss.item(), epoch_real_tokens.item(), epoch_total_tokens)
+                    checkpoints.save(training_state(epoch, b_idx + 1, epoch_start_state, epoch_totals), step)
+
+                if stop:
+                    break
+
+            # Streaming loaders have no len(), count the batches instead
+            avg_epoch_loss = epoch_loss.item() / max(b_idx + 1, 1)
+            if dist.is_initialized():
+                # Tokens of all the ranks
+                epoch_tokens = torch.stack([epoch_real_tokens, torch.tensor(epoch_total_tokens, device=config['DEVICE'])])
+                dist.all_reduce(epoch_tokens)
+                epoch_real_tokens, epoch_total_tokens = epoch_tokens
+                epoch_total_tokens = epoch_total_tokens.item()
+            epoch_real_tokens = epoch_real_tokens.item()
+            real_tokens_per_sec = epoch_real_tokens / (time.perf_counter() - epoch_start)
+            log(f"Epoch {epoch+1}/{config['EPOCHS']} completed with average training loss: {avg_epoch_loss}")
+            padding_efficiency = epoch_real_tokens / max(epoch_total_tokens, 1)
+            log(f"Real (non-pad) tokens/sec: {real_tokens_per_sec:.0f}, padding efficiency: {padding_efficiency:.1%}")
+            metrics.log({"real_tokens_per_sec": real_tokens_per_sec, "padding_efficiency": padding_efficiency})
+
+            if not config['EVAL_EVERY_STEPS']:
+                stop = validate(f"{epoch+1} epochs")
+
+            if checkpoints is not None and main_process:
+                # Start of the next epoch
+                next_epoch_state = {'rng': rng_state(), 'sampler': batch_sampler.state_dict() if batch_sampler is not None else None}
+                checkpoints.save(training_state(epoch + 1, 0, next_epoch_state, (0.0, 0, 0)), step)
+
+            if stop:
+                log("Early stopping triggered.")
+                break
+
+        if best_weights.saved:
+            best_weights.restore(model)
+            log(f"Restored the weights of the best validation loss: {best_val_loss}")
+
+    except KeyboardInterrupt:
+        log("Training interrupted.")
+    finally:
+        # Logs the steps since the last flush and waits for the sinks and the checkpoint writes
+        metrics.close()
+        if checkpoints is not None:
+            checkpoints.close()
+    log("Training completed.")
+
+
+def check_precision_parity(model, train_loader, optimizer, config, loss_fn, n_steps=20):
+    """
+    Trains two copies of model for n_steps on the same batches, one in fp32 and one in config['PRECISION'],
+    and prints both loss curves. model and optimizer are left untouched. Returns the max absolute loss difference.
+    """
+    losses = {}
+    batches = []
+    for batch in train_loader:
+        batches.append(batch)
+        if len(batches) == n_steps:
+            break
+
+    for precision in ("fp32", config['PRECISION']):
+        run_config = dict(config, PRECISION=precision)
+        run_model = copy.deepcopy(model).train()
+        # Fresh optimizer of the same kind, so both runs start from the same state
+        run_optimizer = optimizer.__class__(run_model.parameters(), **optimizer.defaults)
+        scaler = make_grad_scaler(precision, config['DEVICE'])
+        torch.manual_seed(0)  # Same dropout masks in both runs
+        losses[precision] = [train_step(run_model, batch, run_optimizer, run_config, loss_fn, scaler).item() for batch in batches]
+        del run_model, run_optimizer
+
+    diffs = [abs(a - b) for a, b in zip(losses["fp32"], losses[config['PRECISION']])]
+    for step, (fp32_loss, loss) in enumerate(zip(losses["fp32"], losses[config['PRECISION']])):
+        print(f"Step {step+1}: fp32 loss {fp32_loss:.4f}, {config['PRECISION']} loss {loss:.4f}")
+    print(f"Max loss difference over {len(batches)} steps: {max(diffs):.4f}")
+    return max(diffs)